@@ -0,0 +1,158 @@
+import json
+from os import path as osp
+
+import torch
+from torch import nn
+
+from networks import TpsGridGen
+
+BACKENDS = ('eager', 'torchscript', 'onnxruntime')
+# graph file extension of each exporting backend
+EXTENSIONS = {'torchscript': '.ts', 'onnxruntime': '.onnx'}
+# the exported graphs (see export.py): SegGenerator, GMM.encode_cloth, GMM.compute_theta from the cloth features,
+# TpsGridGen and ALIASGenerator with its noise as inputs
+GRAPHS = ('seg', 'gmm_cloth', 'gmm_theta', 'tps', 'alias')
+# options fixed in an exported graph (sizes and structure), which must match those of the run
+EXPORT_OPTIONS = ('load_height', 'load_width', 'semantic_nc', 'grid_size', 'warp_grid_factor', 'ngf', 'norm_G',
+                  'num_upsampling_layers')
+
+
+def graph_path(opt, graph, backend):
+    return osp.join(opt.export_dir, graph + EXTENSIONS[backend])
+
+
+def metadata_path(opt):
+    return osp.join(opt.export_dir, 'export.json')
+
+
+def load_metadata(opt, backend):
+    """export.json, checked against the options and checkpoints of the run."""
+    if not osp.exists(metadata_path(opt)):
+        raise ValueError("'{}' does not exist: run export.py first".format(metadata_path(opt)))
+    with open(metadata_path(opt), 'r') as f:
+        metadata = json.load(f)
+    for name in EXPORT_OPTIONS:
+        if metadata['options'][name] != getattr(opt, name):
+            raise ValueError("the graphs in '{}' were exported with --{} {}, not {}: run export.py again".format(
+                opt.export_dir, name, metadata['options'][name], getattr(opt, name)))
+    checkpoint_paths = [osp.join(opt.checkpoint_dir, checkpoint)
+                        for checkpoint in (opt.seg_checkpoint, opt.gmm_checkpoint, opt.alias_checkpoint)]
+    for graph in GRAPHS:
+        path = graph_path(opt, graph, backend)
+        if not osp.exists(path):
+            raise ValueError("'{}' does not exist: run export.py --export_formats {}".format(path, backend))
+        for checkpoint_path in checkpoint_paths:
+            if osp.exists(checkpoint_path) and osp.getmtime(path) < osp.getmtime(checkpoint_path):
+                raise ValueError("'{}' is older than '{}': run export.py again".format(path, checkpoint_path))
+    return metadata
+
+
+def torchscript_runner(path):
+    return torch.jit.load(path)
+
+
+def onnxruntime_runner(path):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("the onnxruntime backend needs the onnxruntime package (pip install onnxruntime)")
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    input_names = [graph_input.name for graph_input in session.get_inputs()]
+
+    def run(*inputs):
+        feed = {name: x.detach().float().contiguous().numpy() for name, x in zip(input_names, inputs)}
+        return torch.from_numpy(session.run(None, feed)[0])
+    return run
+
+
+class GraphModule(nn.Module):
+    """
+    nn.Module running an exported graph, so the callers keep the module API (eval, share_memory, forward hooks of the
+    profiler). A TorchScript graph is a submodule, whose weights share_memory() moves like those of an eager network.
+    """
+
+    def __init__(self, run):
+        super(GraphModule, self).__init__()
+        self.run = run
+
+    def forward(self, *inputs):
+        return self.run(*inputs)
+
+
+class ExportedGMM(nn.Module):
+    # The GMM interface used by the try-on pipeline (encode_cloth, compute_theta, gridGen) over the exported graphs.
+    # The TPS grid graph is exported at the load size; other sizes (previews) are warped by an eager TpsGridGen,
+    # built on first use, which only holds buffers derived from the options.
+    def __init__(self, opt, load_graph):
+        super(ExportedGMM, self).__init__()
+        self.extractionB = GraphModule(load_graph('gmm_cloth'))
+        self.theta = GraphModule(load_graph('gmm_theta'))
+        self.gridGen = ExportedTpsGridGen(opt, load_graph('tps'))
+
+    def encode_cloth(self, inputB):
+        return self.extractionB(inputB)
+
+    def compute_theta(self, inputA, inputB=None, featureB=None):
+        if featureB is None:
+            featureB = self.encode_cloth(inputB)
+        return self.theta(inputA, featureB)
+
+    def forward(self, inputA, inputB=None, featureB=None, size=None):
+        theta = self.compute_theta(inputA, inputB, featureB)
+        return theta, self.gridGen(theta, size)
+
+
+class ExportedTpsGridGen(nn.Module):
+    def __init__(self, opt, run):
+        super(ExportedTpsGridGen, self).__init__()
+        self.graph = GraphModule(run)
+        self.opt = opt
+        self.size = (opt.load_height, opt.load_width)
+        self.eager = None
+
+    def forward(self, theta, size=None):
+        if size is None or tuple(size) == self.size:
+            return self.graph(theta)
+        if self.eager is None:
+            self.eager = TpsGridGen(self.opt, grid_factor=self.opt.warp_grid_factor)
+        return self.eager(theta, size)
+
+
+class ExportedALIASGenerator(nn.Module):
+    # Draws the noise of every ALIASNorm in call order, as the eager network does, and feeds it to the graph.
+    def __init__(self, opt, run, noise_sizes):
+        super(ExportedALIASGenerator, self).__init__()
+        self.graph = GraphModule(run)
+        self.size = (opt.load_height, opt.load_width)
+        self.noise_sizes = [tuple(size) for size in noise_sizes]
+
+    def forward(self, x, seg, seg_div, misalign_mask):
+        if tuple(x.size()[2:]) != self.size:
+            raise ValueError("ALIASGenerator was exported at {}x{}, not {}x{}: export it at this load size".format(
+                self.size[0], self.size[1], x.size(2), x.size(3)))
+        noise = [torch.randn(x.size(0), *size) for size in self.noise_sizes]
+        return self.graph(x, seg, seg_div, misalign_mask, *noise)
+
+
+def load_exported_networks(opt):
+    """(seg, gmm, alias) of opt.backend, with the interface of the eager networks the try-on pipeline uses."""
+    metadata = load_metadata(opt, opt.backend)
+    runner = torchscript_runner if opt.backend == 'torchscript' else onnxruntime_runner
+
+    def load_graph(graph):
+        return runner(graph_path(opt, graph, opt.backend))
+
+    seg = GraphModule(load_graph('seg'))
+    gmm = ExportedGMM(opt, load_graph)
+    alias = ExportedALIASGenerator(opt, load_graph('alias'), metadata['noise_sizes'])
+    return seg, gmm, alias
+
+
+def write_metadata(opt, noise_sizes):
+    with open(metadata_path(opt), 'w') as f:
+        json.dump({
+            'options': {name: getattr(opt, name) for name in EXPORT_OPTIONS},
+            'noise_sizes': noise_sizes,
+        }, f, indent=2)
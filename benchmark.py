@@ -0,0 +1,464 @@
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from collections import OrderedDict
+from os import path as osp
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.nn import functional as F
+from torch.utils import data
+from torchvision import transforms
+
+from backends import BACKENDS
+from datasets import VITONDataset, VITONDataLoader, read_pairs
+from networks import TpsGridGen
+from pool import TryOnPool, split_threads
+from test import (build_networks, downsample_inputs, get_parser, iter_tryon, load_networks, make_cloth_cache, parse_at,
+                  segment, synthesize, warp)
+from utils import blur, save_images
+
+SUITE_COMPONENTS = ['dataset', 'seg', 'gmm', 'tps', 'alias', 'test']
+
+
+def percentile(values, q):
+    # nearest-rank percentile
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(np.ceil(q / 100 * len(values))) - 1))]
+
+
+def latency_stats(latencies):
+    return {
+        'mean': sum(latencies) / len(latencies),
+        'min': min(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def measure_latency(fn, repeat):
+    fn()  # warm-up
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latency_stats(latencies)
+
+
+def _peak_memory_worker(fn, conn):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn()
+    conn.send((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start) * 1024)
+    conn.close()
+
+
+def measure_peak_memory(fn):
+    """Growth of the peak RSS while running `fn` once, in bytes (measured in a forked process)."""
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_peak_memory_worker, args=(fn, child_conn))
+    process.start()
+    peak = parent_conn.recv()
+    process.join()
+    return peak
+
+
+def benchmark_tps(opt):
+    grid_gen = TpsGridGen(opt)
+    theta = torch.randn(opt.batch_size, 2 * grid_gen.N) * 0.05
+    points = torch.cat((grid_gen.grid_X, grid_gen.grid_Y), 3)
+
+    def dense():
+        with torch.no_grad():
+            return grid_gen.apply_transformation(theta, points)
+
+    def basis():
+        with torch.no_grad():
+            return grid_gen(theta)
+
+    print("TpsGridGen at {}x{}, grid size {}, batch size {} (basis buffer: {:.1f} MB)".format(
+        opt.load_height, opt.load_width, opt.grid_size, opt.batch_size,
+        grid_gen.basis.numel() * grid_gen.basis.element_size() / 2**20))
+    print("max abs difference: {:.3e}".format((dense() - basis()).abs().max().item()))
+    for name, fn in [('dense', dense), ('basis', basis)]:
+        latency = measure_latency(fn, opt.repeat)
+        print("{:>6}: {:8.2f} ms mean, {:8.2f} ms min, {:8.1f} MB peak".format(
+            name, latency['mean'] * 1000, latency['min'] * 1000, measure_peak_memory(fn) / 2**20))
+
+
+def benchmark_warp_grid(opt):
+    theta = torch.randn(opt.batch_size, 2 * opt.grid_size**2) * 0.05
+    _, c_name = read_pairs(osp.join(opt.dataset_dir, opt.dataset_list))[0]
+    c, _ = VITONDataset(opt).get_cloth(c_name)
+    c = c[None].expand(opt.batch_size, -1, -1, -1)
+
+    with torch.no_grad():
+        exact_grid = TpsGridGen(opt)(theta)
+        exact_c = F.grid_sample(c, exact_grid, padding_mode='border')
+
+    print("TPS grid at {}x{}, batch size {}".format(opt.load_height, opt.load_width, opt.batch_size))
+    print("factor | grid ms | grid+sample ms | max err (px) | mean err (px) | warped cloth mean abs err (/255)")
+    for factor in [1, 2, 4, 8]:
+        grid_gen = TpsGridGen(opt, grid_factor=factor)
+
+        def grid():
+            with torch.no_grad():
+                return grid_gen(theta)
+
+        def warp():
+            with torch.no_grad():
+                return F.grid_sample(c, grid_gen(theta), padding_mode='border')
+
+        # normalized [-1, 1] coordinates -> pixels
+        error = (grid() - exact_grid).abs() * torch.tensor([opt.load_width / 2, opt.load_height / 2])
+        cloth_error = (warp() - exact_c).abs().mean().item() * 255 / 2
+        print("{:>6} | {:7.2f} | {:14.2f} | {:12.4f} | {:13.4f} | {:.4f}".format(
+            factor, measure_latency(grid, opt.repeat)['mean'] * 1000, measure_latency(warp, opt.repeat)['mean'] * 1000,
+            error.max().item(), error.mean().item(), cloth_error))
+
+
+def benchmark_agnostic(opt):
+    dataset = VITONDataset(opt)
+    img_names = list(OrderedDict.fromkeys(dataset.img_names))
+
+    print("agnostic masks at {}x{} (times in ms, mismatches in pixels)".format(opt.load_height, opt.load_width))
+    print("{:>14} | parse pil | parse cv2 | mismatch | img pil | img cv2 | mismatch".format('person'))
+    for img_name in img_names:
+        with open(osp.join(dataset.data_path, 'openpose-json', img_name.replace('.jpg', '_keypoints.json'))) as f:
+            pose_data = np.array(json.load(f)['people'][0]['pose_keypoints_2d']).reshape((-1, 3))[:, :2]
+        parse = Image.open(osp.join(dataset.data_path, 'image-parse', img_name.replace('.jpg', '.png')))
+        parse = transforms.Resize(opt.load_width, interpolation=0)(parse)
+        img = Image.open(osp.join(dataset.data_path, 'image', img_name))
+        img = transforms.Resize(opt.load_width, interpolation=2)(img)
+
+        # get_img_agnostic_pil modifies pose_data in place, hence the copies
+        row = [img_name]
+        for pil_fn, cv2_fn in [(lambda: dataset.get_parse_agnostic_pil(parse, pose_data.copy()),
+                                lambda: dataset.get_parse_agnostic(parse, pose_data.copy())),
+                               (lambda: dataset.get_img_agnostic_pil(img, parse, pose_data.copy()),
+                                lambda: dataset.get_img_agnostic(img, parse, pose_data.copy()))]:
+            mismatch = np.array(pil_fn()) != cv2_fn()
+            if mismatch.ndim == 3:
+                mismatch = mismatch.any(2)
+            row += [measure_latency(pil_fn, opt.repeat)['mean'] * 1000, measure_latency(cv2_fn, opt.repeat)['mean'] * 1000,
+                    int(mismatch.sum())]
+        print("{:>14} | {:9.2f} | {:9.2f} | {:8d} | {:7.2f} | {:7.2f} | {:8d}".format(*row))
+
+
+def benchmark_parse(opt):
+    # Cost and quality delta of --fast_parse (blur and argmax at 256x192, then nearest upsampling) against the default
+    # (bilinear upsampling of the logits, blur and argmax at the output size), on the samples of the dataset list.
+    seg, gmm, alias = make_suite_networks(opt)
+    dataset = VITONDataset(opt)
+    size = (opt.load_height, opt.load_width)
+
+    print("parse maps at {}x{} ({} weights)".format(opt.load_height, opt.load_width, opt.weights))
+    print("{:>14} | exact ms | fast ms | label mismatch | output mean abs err (/255) | output PSNR (dB)".format('person'))
+    with torch.no_grad():
+        for index in range(len(dataset)):
+            inputs = data.default_collate([dataset[index]])
+            low = downsample_inputs(inputs)
+            logits = segment(seg, low)
+            exact = parse_at(logits, size)
+            fast = parse_at(logits, size, fast=True)
+            mismatch = (exact.argmax(dim=1) != fast.argmax(dim=1)).float().mean().item()
+
+            outputs = []
+            for parse in (exact, fast):
+                torch.manual_seed(0)  # same ALIASGenerator noise for both
+                theta = warp(gmm, inputs, low, parse)
+                outputs.append(synthesize(gmm, alias, inputs, parse, theta))
+            mse = (((outputs[0] - outputs[1]) / 2) ** 2).mean().item()  # on [0, 1] images
+            print("{:>14} | {:8.1f} | {:7.1f} | {:13.3f}% | {:26.3f} | {:16.2f}".format(
+                dataset.img_names[index],
+                measure_latency(lambda: parse_at(logits, size), opt.repeat)['mean'] * 1000,
+                measure_latency(lambda: parse_at(logits, size, fast=True), opt.repeat)['mean'] * 1000,
+                mismatch * 100, (outputs[0] - outputs[1]).abs().mean().item() * 255 / 2,
+                10 * np.log10(1 / max(mse, 1e-12))))
+
+
+def benchmark_blur(opt):
+    # The project's separable Gaussian and box blurs against torchgeometry's GaussianBlur (the original implementation,
+    # only needed here), on the upsampled segmentation logits of the samples of the dataset list.
+    try:
+        import torchgeometry as tgm
+    except ImportError:
+        tgm = None
+        print("torchgeometry is not installed: comparing the box blur against the separable Gaussian only")
+
+    seg, _, _ = make_suite_networks(opt)
+    dataset = VITONDataset(opt)
+    up = torch.nn.Upsample(size=(opt.load_height, opt.load_width), mode='bilinear')
+    blurs = OrderedDict()
+    if tgm is not None:
+        blurs['tgm'] = tgm.image.GaussianBlur((15, 15), (3, 3))
+    blurs['gaussian'] = lambda x: blur(x, 15, 3, 'gaussian')
+    blurs['box'] = lambda x: blur(x, 15, 3, 'box')
+    reference = next(iter(blurs))
+
+    print("blur of the 13-channel segmentation logits at {}x{} (reference: {})".format(
+        opt.load_height, opt.load_width, reference))
+    print("{:>14} | {:>8} | {:>8} | {:>11} | {:>14}".format('person', 'blur', 'ms', 'max abs err', 'label mismatch'))
+    with torch.no_grad():
+        for index in range(len(dataset)):
+            logits = up(segment(seg, downsample_inputs(data.default_collate([dataset[index]]))))
+            expected = blurs[reference](logits)
+            for name, fn in blurs.items():
+                blurred = fn(logits)
+                mismatch = (blurred.argmax(dim=1) != expected.argmax(dim=1)).float().mean().item()
+                print("{:>14} | {:>8} | {:8.1f} | {:11.2e} | {:13.4f}%".format(
+                    dataset.img_names[index], name, measure_latency(lambda: fn(logits), opt.repeat)['mean'] * 1000,
+                    (blurred - expected).abs().max().item(), mismatch * 100))
+
+
+def benchmark_pool(opt):
+    # Scaling of the worker pool: every split of each core count into worker processes x intra-op threads renders the
+    # same pairs (the dataset list, repeated up to --pool_images). The parent stays single-threaded, see TryOnPool.
+    torch.set_num_threads(1)
+    networks = make_suite_networks(opt)
+    pairs = read_pairs(osp.join(opt.dataset_dir, opt.dataset_list))
+    pairs = (pairs * int(np.ceil(opt.pool_images / len(pairs))))[:opt.pool_images]
+    core_counts = opt.cores or [2**k for k in range(int(np.log2(os.cpu_count())) + 1)]
+
+    baseline = None
+    print("{:>5} | {:>7} | {:>7} | {:>8} | {:>7} | {:>10}".format(
+        'cores', 'workers', 'threads', 'images/s', 'speedup', 'efficiency'))
+    with tempfile.TemporaryDirectory() as save_dir:
+        pool_opt = copy.copy(opt)
+        pool_opt.save_dir = save_dir
+        for num_cores in core_counts:
+            for num_workers in [n for n in range(1, num_cores + 1) if num_cores % n == 0]:
+                pool = TryOnPool(pool_opt, *networks, num_workers, split_threads(num_cores, num_workers))
+                try:
+                    pool.run(pairs[:num_workers])  # warm-up: one pair per worker
+                    num_images, seconds, _ = pool.run(pairs)
+                finally:
+                    pool.close()
+                throughput = num_images / seconds
+                if baseline is None:
+                    baseline = throughput / num_cores
+                print("{:5d} | {:7d} | {:7d} | {:8.3f} | {:6.2f}x | {:9.0%}".format(
+                    num_cores, num_workers, num_cores // num_workers, throughput, throughput / baseline,
+                    throughput / baseline / num_cores))
+
+
+def flatten_outputs(output):
+    return torch.cat([x.reshape(-1) for x in output]) if isinstance(output, tuple) else output.reshape(-1)
+
+
+def benchmark_backends(opt):
+    # The seg, gmm, tps and alias suite cases on each backend, with the same inputs (and noise): latency and max abs
+    # difference of the outputs to the eager networks. The graphs are those exported by export.py to --export_dir.
+    backend_opt = copy.copy(opt)
+    backend_opt.components = ['seg', 'gmm', 'tps', 'alias']
+    reference = {}
+    print("{:<12} | {:<6} | {:>9} | {:>9} | {:>9} | {:>13}".format(
+        'backend', 'case', 'mean ms', 'p50 ms', 'speedup', 'max abs diff'))
+    with torch.no_grad():
+        for backend in opt.backends:
+            backend_opt.backend = backend
+            try:
+                networks = load_networks(backend_opt)
+            except (ImportError, ValueError) as e:
+                print("{:<12} | skipped: {}".format(backend, e))
+                continue
+            for name, (fn, _) in suite_cases(backend_opt, networks, opt.batch_size).items():
+                torch.manual_seed(1)
+                output = flatten_outputs(fn())
+                latency = measure_latency(fn, opt.repeat)
+                if name not in reference:
+                    reference[name] = (output, latency)
+                print("{:<12} | {:<6} | {:9.2f} | {:9.2f} | {:8.2f}x | {:13.2e}".format(
+                    backend, name, latency['mean'] * 1000, latency['p50'] * 1000,
+                    reference[name][1]['p50'] / latency['p50'], (output - reference[name][0]).abs().max().item()))
+
+
+def make_suite_networks(opt):
+    torch.manual_seed(0)
+    if opt.weights == 'random':
+        seg, gmm, alias = build_networks(opt)
+    else:
+        seg, gmm, alias = load_networks(opt)
+    for net in (seg, gmm, alias):
+        net.eval()
+    return seg, gmm, alias
+
+
+def suite_cases(opt, networks, batch_size):
+    """{component: (fn, # of samples per call)} at the resolution and batch size of `opt`."""
+    seg, gmm, alias = networks
+    b, h, w = batch_size, opt.load_height, opt.load_width
+    torch.manual_seed(0)
+    cases = OrderedDict()
+
+    if 'dataset' in opt.components:
+        dataset = VITONDataset(opt)
+        indices = itertools.cycle(range(len(dataset)))
+        # __getitem__ always returns one sample; the batch size does not apply
+        cases['dataset'] = (lambda: dataset[next(indices)], 1)
+    if 'seg' in opt.components:
+        seg_input = torch.randn(b, opt.semantic_nc + 8, 256, 192)
+        cases['seg'] = (lambda: seg(seg_input), b)
+    if 'gmm' in opt.components:
+        inputA, inputB = torch.randn(b, 7, 256, 192), torch.randn(b, 3, 256, 192)
+        cases['gmm'] = (lambda: gmm(inputA, inputB), b)
+    if 'tps' in opt.components:
+        theta = torch.randn(b, 2 * opt.grid_size**2) * 0.05
+        cases['tps'] = (lambda: gmm.gridGen(theta), b)
+    if 'alias' in opt.components:
+        parse = torch.rand(b, 7, h, w)
+        misalign_mask = torch.rand(b, 1, h, w)
+        alias_inputs = (torch.randn(b, 9, h, w), parse, torch.cat((parse, misalign_mask), dim=1), misalign_mask)
+        cases['alias'] = (lambda: alias(*alias_inputs), b)
+    return cases
+
+
+def run_suite_test(opt, networks, batch_size, save_dir):
+    # Same loop as test(): data loading, the three networks and save_images, timed per batch.
+    test_opt = copy.copy(opt)
+    test_opt.batch_size = batch_size
+    test_opt.workers = 0
+    cloth_cache = make_cloth_cache(test_opt)
+    loader = VITONDataLoader(test_opt, VITONDataset(test_opt, cloth_cache=cloth_cache))
+
+    latencies = []
+    num_images = 0
+    start = time.perf_counter()
+    for output, unpaired_names in iter_tryon(test_opt, *networks, loader.data_loader, cloth_cache):
+        save_images(output, unpaired_names, save_dir)
+        num_images += len(unpaired_names)
+        now = time.perf_counter()
+        latencies.append(now - start)
+        start = now
+    stats = latency_stats(latencies)
+    stats['throughput'] = num_images / sum(latencies)
+    return stats
+
+
+def benchmark_suite(opt):
+    resolutions = [tuple(int(x) for x in resolution.split('x')) for resolution in opt.resolutions]
+    batch_sizes = opt.batch_sizes or [opt.batch_size]
+    thread_counts = opt.threads or [torch.get_num_threads()]
+    results = OrderedDict()
+
+    print("{:<28} | {:>9} | {:>9} | {:>9} | {:>9} | {:>10}".format(
+        'case', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'samples/s'))
+    with torch.no_grad(), tempfile.TemporaryDirectory() as save_dir:
+        for height, width in resolutions:
+            res_opt = copy.copy(opt)
+            res_opt.load_height, res_opt.load_width = height, width
+            networks = make_suite_networks(res_opt)
+            for num_threads in thread_counts:
+                torch.set_num_threads(num_threads)
+                for batch_size in batch_sizes:
+                    stats = OrderedDict()
+                    for name, (fn, samples) in suite_cases(res_opt, networks, batch_size).items():
+                        stats[name] = measure_latency(fn, opt.repeat)
+                        stats[name]['throughput'] = samples / stats[name]['mean']
+                    if 'test' in opt.components:
+                        stats['test'] = run_suite_test(res_opt, networks, batch_size, save_dir)
+
+                    for name, stat in stats.items():
+                        key = '{}/{}x{}/b{}/t{}'.format(name, height, width, batch_size, num_threads)
+                        results[key] = stat
+                        print("{:<28} | {:9.2f} | {:9.2f} | {:9.2f} | {:9.2f} | {:10.3f}".format(
+                            key, stat['mean'] * 1000, stat['p50'] * 1000, stat['p90'] * 1000, stat['p99'] * 1000,
+                            stat['throughput']))
+
+    report = {
+        'meta': {
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'weights': opt.weights,
+            'repeat': opt.repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if opt.save_baseline:
+        with open(opt.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("baseline saved to {}".format(opt.save_baseline))
+    if opt.baseline:
+        with open(opt.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline['results'], opt.threshold)
+        if regressions:
+            raise SystemExit("{} regression(s) beyond {:.0%}: {}".format(
+                len(regressions), opt.threshold, ', '.join(regressions)))
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """Prints the change of the median latency of every case also in `baseline`; returns the regressed cases."""
+    regressions = []
+    print("{:<28} | {:>11} | {:>11} | {:>8}".format('case', 'base p50 ms', 'p50 ms', 'change'))
+    for key, stat in results.items():
+        if key not in baseline:
+            continue
+        change = stat['p50'] / baseline[key]['p50'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(key)
+        print("{:<28} | {:11.2f} | {:11.2f} | {:+7.1%}{}".format(
+            key, baseline[key]['p50'] * 1000, stat['p50'] * 1000, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--benchmark',
+                        choices=['tps', 'warp_grid', 'agnostic', 'parse', 'blur', 'pool', 'suite', 'backends'],
+                        required=True)
+    parser.add_argument('--repeat', type=int, default=10)
+
+    # for the suite (--weights also applies to the parse, blur and pool benchmarks)
+    parser.add_argument('--components', nargs='+', choices=SUITE_COMPONENTS, default=SUITE_COMPONENTS)
+    parser.add_argument('--weights', choices=['checkpoint', 'random'], default='checkpoint',
+                        help='load the checkpoints, or use randomly initialized networks')
+    parser.add_argument('--resolutions', nargs='+', default=['1024x768'], help='HEIGHTxWIDTH load sizes to sweep')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', help='batch sizes to sweep (default: --batch_size)')
+    parser.add_argument('--threads', type=int, nargs='+', help='intra-op thread counts to sweep (default: the current setting)')
+    parser.add_argument('--save_baseline', type=str, default='', help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='compare the median latencies to this JSON baseline and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown counted as a regression')
+
+    # for the worker pool
+    parser.add_argument('--cores', type=int, nargs='+',
+                        help='core counts to sweep, each split every way into workers x intra-op threads '
+                             '(default: powers of 2 up to the # of CPUs)')
+    parser.add_argument('--pool_images', type=int, default=16, help='# of images rendered per configuration')
+
+    # for the backends
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS),
+                        help='backends to compare, the first one being the reference')
+    opt = parser.parse_args()
+
+    if opt.benchmark == 'tps':
+        benchmark_tps(opt)
+    elif opt.benchmark == 'warp_grid':
+        benchmark_warp_grid(opt)
+    elif opt.benchmark == 'agnostic':
+        benchmark_agnostic(opt)
+    elif opt.benchmark == 'parse':
+        benchmark_parse(opt)
+    elif opt.benchmark == 'blur':
+        benchmark_blur(opt)
+    elif opt.benchmark == 'pool':
+        benchmark_pool(opt)
+    elif opt.benchmark == 'suite':
+        benchmark_suite(opt)
+    elif opt.benchmark == 'backends':
+        benchmark_backends(opt)
+
+
+if __name__ == '__main__':
+    main()
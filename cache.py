@@ -0,0 +1,328 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from os import path as osp
+
+import numpy as np
+import torch
+
+
+def person_source_paths(data_path, img_name):
+    # the files the person tensors (and so every try-on of the person) are computed from
+    return [
+        osp.join(data_path, 'image', img_name),
+        osp.join(data_path, 'image-parse', img_name.replace('.jpg', '.png')),
+        osp.join(data_path, 'openpose-img', img_name.replace('.jpg', '_rendered.png')),
+        osp.join(data_path, 'openpose-json', img_name.replace('.jpg', '_keypoints.json')),
+    ]
+
+
+class PersonCache:
+    """
+    On-disk cache of the cloth-independent person tensors built by VITONDataset.get_person.
+
+    Every person gets a directory `<cache_dir>/<load_height>x<load_width>/<img_name>/` holding one .npy file per
+    tensor and a meta.json with the modification times of the source files it was computed from. Arrays are
+    memory-mapped on load, and an entry whose sources changed since it was written is recomputed automatically.
+    """
+    keys = ('img', 'img_agnostic', 'parse_agnostic', 'pose')
+    # parse_agnostic is a one-hot label map, so it is stored as uint8 (4x smaller) and converted back on load
+    dtypes = {'parse_agnostic': np.uint8}
+
+    def __init__(self, cache_dir, data_path, load_height, load_width):
+        self.cache_dir = osp.join(cache_dir, '{}x{}'.format(load_height, load_width))
+        self.data_path = data_path
+
+    def source_mtimes(self, img_name):
+        return {osp.relpath(p, self.data_path): os.stat(p).st_mtime_ns
+                for p in person_source_paths(self.data_path, img_name)}
+
+    def entry_dir(self, img_name):
+        return osp.join(self.cache_dir, img_name)
+
+    def is_valid(self, img_name):
+        meta_path = osp.join(self.entry_dir(img_name), 'meta.json')
+        if not osp.exists(meta_path):
+            return False
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        return meta['sources'] == self.source_mtimes(img_name)
+
+    def load(self, img_name):
+        person = {}
+        for key in self.keys:
+            # copy-on-write mapping: pages are read lazily and the resulting tensors are writable
+            array = np.load(osp.join(self.entry_dir(img_name), key + '.npy'), mmap_mode='c')
+            person[key] = torch.from_numpy(array).float()
+        return person
+
+    def save(self, img_name, person):
+        entry_dir = self.entry_dir(img_name)
+        os.makedirs(entry_dir, exist_ok=True)
+        for key in self.keys:
+            array = person[key].numpy().astype(self.dtypes.get(key, np.float32))
+            # unique temporary names, so concurrent requests building the same entry never mix their files
+            tmp_path = osp.join(entry_dir, '{}.{}.tmp.npy'.format(key, uuid.uuid4().hex))
+            np.save(tmp_path, array)
+            os.replace(tmp_path, osp.join(entry_dir, key + '.npy'))
+
+        # meta.json is written last, so a partially written entry is never considered valid
+        tmp_path = osp.join(entry_dir, 'meta.json.{}.tmp'.format(uuid.uuid4().hex))
+        with open(tmp_path, 'w') as f:
+            json.dump({'img_name': img_name, 'sources': self.source_mtimes(img_name)}, f)
+        os.replace(tmp_path, osp.join(entry_dir, 'meta.json'))
+
+    def get(self, img_name, compute):
+        """Returns the cached tensors of `img_name`, (re)building the entry with `compute(img_name)` if needed."""
+        if self.is_valid(img_name):
+            return self.load(img_name)
+        person = compute(img_name)
+        self.save(img_name, person)
+        return person
+
+
+class ClothCache:
+    """
+    Size-bounded LRU cache of per-cloth tensors: the resized cloth, its binarized mask and the normalized GMM
+    extractionB features.
+
+    Entries are keyed by cloth name, the modification times of the cloth and its mask, and the load size, so a
+    re-uploaded cloth never hits a stale entry. When `spill_dir` is given, evicted entries are written there with
+    torch.save and reloaded on the next miss. The features are only valid for the GMM they were computed with, so a
+    cache must not be shared between different GMM checkpoints.
+    """
+
+    def __init__(self, data_path, load_height, load_width, max_entries=8, spill_dir=None):
+        self.data_path = data_path
+        self.load_height = load_height
+        self.load_width = load_width
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # DataLoader workers may receive a pickled copy; locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def key(self, c_name):
+        mtimes = [os.stat(osp.join(self.data_path, folder, c_name)).st_mtime_ns for folder in ('cloth', 'cloth-mask')]
+        return '{}-{}-{}-{}x{}'.format(c_name, mtimes[0], mtimes[1], self.load_height, self.load_width)
+
+    def spill_path(self, key):
+        return osp.join(self.spill_dir, key + '.pt')
+
+    def lookup(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.spill_dir and osp.exists(self.spill_path(key)):
+            entry = torch.load(self.spill_path(key))
+            self.insert(key, entry)
+            return entry
+        return None
+
+    def insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            if self.spill_dir:
+                torch.save(old_entry, self.spill_path(old_key))
+
+    def get_entry(self, c_name):
+        key = self.key(c_name)
+        with self.lock:
+            entry = self.lookup(key)
+            if entry is None:
+                entry = {}
+                self.insert(key, entry)
+        return entry
+
+    def get_cloth(self, c_name, compute):
+        """Returns (cloth, cloth_mask) of `c_name`, loading them with `compute(c_name)` on a miss."""
+        entry = self.get_entry(c_name)
+        if 'cloth_mask' not in entry:  # assigned last, see below
+            with self.lock:
+                # checked again under the lock, so concurrent misses compute (and assign) the entry only once
+                if 'cloth_mask' not in entry:
+                    entry['cloth'], entry['cloth_mask'] = compute(c_name)
+        return entry['cloth'], entry['cloth_mask']
+
+    def get_feature(self, c_name, compute):
+        """Returns the GMM cloth features of `c_name`, computing them with `compute()` on a miss."""
+        entry = self.get_entry(c_name)
+        if 'feature' not in entry:
+            with self.lock:
+                if 'feature' not in entry:
+                    entry['feature'] = compute()
+        return entry['feature']
+
+
+def checkpoint_names(opt):
+    names = [opt.seg_checkpoint, opt.gmm_checkpoint, opt.alias_checkpoint]
+    if getattr(opt, 'quantize', False):
+        # the int8 checkpoints (see test.derived_checkpoint_path) also depend on their calibration
+        names += ['{}_int8{}'.format(*osp.splitext(name)) for name in names]
+    return names
+
+
+class ResultCache:
+    """
+    Content-addressed, size-bounded LRU cache of try-on output JPEGs on disk.
+
+    An output is stored as `<cache_dir>/<key[:2]>/<key>.jpg`, where the key hashes the bytes of the cloth and its mask,
+    the person id and the modification times of its source files, the digests of the three checkpoints and the
+    options affecting the output (`OPTIONS`). A re-uploaded cloth therefore hits the entries of its first upload, while
+    a retrained checkpoint or a different resolution never does. While the entries take more than `max_mb`, the least
+    recently used ones are deleted; the order survives restarts through the file modification times, which hits
+    refresh. The networks add random noise to their inputs, so a hit returns the same sample of the output
+    distribution as the first run.
+    """
+    # options changing the output images; the network structure options also change the checkpoints' meaning
+    OPTIONS = ('load_height', 'load_width', 'fast_parse', 'blur_mode', 'agnostic_impl', 'warp_grid_factor', 'grid_size',
+               'semantic_nc', 'ngf', 'norm_G', 'num_upsampling_layers', 'freeze', 'quantize', 'precision',
+               'backend')
+
+    # # of memoized file digests (the checkpoints and the most recent cloths and masks)
+    MAX_FILE_DIGESTS = 256
+
+    def __init__(self, cache_dir, max_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 2**20
+        self.lock = threading.Lock()
+        self.file_digests = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for root, _, files in os.walk(cache_dir):
+            for name in files:
+                if name.endswith('.jpg'):
+                    st = os.stat(osp.join(root, name))
+                    entries.append((st.st_mtime_ns, name[:-len('.jpg')], st.st_size))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_bytes = sum(self.entries.values())
+
+    def file_digest(self, path):
+        # memoized per (path, mtime, size): the checkpoints and a cloth are hashed once, not once per pair
+        st = os.stat(path)
+        memo_key = (osp.abspath(path), st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if memo_key in self.file_digests:
+                self.file_digests.move_to_end(memo_key)
+                return self.file_digests[memo_key]
+        # hashed outside the lock, so a large file never blocks the lookups of other requests
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.file_digests[memo_key] = digest.hexdigest()
+            while len(self.file_digests) > self.MAX_FILE_DIGESTS:
+                self.file_digests.popitem(last=False)
+        return digest.hexdigest()
+
+    def key(self, opt, img_name, c_name):
+        data_path = osp.join(opt.dataset_dir, opt.dataset_mode)
+        content = {
+            'cloth': [self.file_digest(osp.join(data_path, folder, c_name)) for folder in ('cloth', 'cloth-mask')],
+            'person': img_name,
+            'person_sources': [os.stat(p).st_mtime_ns for p in person_source_paths(data_path, img_name)],
+            'checkpoints': [self.file_digest(osp.join(opt.checkpoint_dir, name)) for name in checkpoint_names(opt)],
+            'options': {name: getattr(opt, name, None) for name in self.OPTIONS},
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return osp.join(self.cache_dir, key[:2], key + '.jpg')
+
+    def get(self, key, output_path):
+        """Copies the cached output of `key` to `output_path`; returns False on a miss."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            try:
+                os.utime(self.path(key))
+                shutil.copyfile(self.path(key), output_path)
+            except OSError:
+                # deleted on disk (e.g. evicted by another process sharing the directory): forget it and re-render
+                self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return True
+
+    def put(self, key, output_path):
+        """Stores a copy of the output image at `output_path` as the entry of `key`."""
+        path = self.path(key)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes += os.stat(path).st_size - self.entries.pop(key, 0)
+            self.entries[key] = os.stat(path).st_size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                self.evictions += 1
+                try:
+                    os.remove(self.path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+        }
+
+
+def main():
+    from datasets import VITONDataset, read_pairs
+    from test import get_parser
+
+    parser = get_parser()
+    parser.add_argument('--rebuild', action='store_true', help='recompute every entry, even if it is up to date')
+    opt = parser.parse_args()
+    opt.person_cache = True
+
+    dataset = VITONDataset(opt)
+    img_names = []
+    for img_name, _ in read_pairs(osp.join(opt.dataset_dir, opt.dataset_list)):
+        if img_name not in img_names:
+            img_names.append(img_name)
+
+    for img_name in img_names:
+        if dataset.person_cache.is_valid(img_name) and not opt.rebuild:
+            print("up to date: {}".format(img_name))
+            continue
+        dataset.person_cache.save(img_name, dataset.get_person(img_name))
+        print("cached: {}".format(img_name))
+    print("person cache: {}".format(dataset.person_cache.cache_dir))
+
+
+if __name__ == '__main__':
+    main()
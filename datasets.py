@@ -1,46 +1,142 @@
 import json
 from os import path as osp
 
+import cv2
 import numpy as np
 from PIL import Image, ImageDraw
 import torch
 from torch.utils import data
 from torchvision import transforms
 
+from cache import PersonCache
+from profiler import PROFILER
+from utils import make_label_lut, remap_one_hot
+
+
+# 20 human parsing labels -> 13 classes of the parse agnostic map
+PARSE_AGNOSTIC_LABELS = {
+    0: ['background', [0, 10]],
+    1: ['hair', [1, 2]],
+    2: ['face', [4, 13]],
+    3: ['upper', [5, 6, 7]],
+    4: ['bottom', [9, 12]],
+    5: ['left_arm', [14]],
+    6: ['right_arm', [15]],
+    7: ['left_leg', [16]],
+    8: ['right_leg', [17]],
+    9: ['left_shoe', [18]],
+    10: ['right_shoe', [19]],
+    11: ['socks', [8]],
+    12: ['noise', [3, 11]]
+}
+PARSE_AGNOSTIC_LUT = make_label_lut(PARSE_AGNOSTIC_LABELS, 20)
+
+
+def label_lut(labels):
+    # 255 for the given labels of the 20-class human parsing map, 0 otherwise (for cv2.LUT)
+    return np.isin(np.arange(256), labels).astype(np.uint8) * 255
+
+
+PARSE_UPPER_AND_NECK = label_lut([5, 6, 7, 10])
+PARSE_HEAD_AND_LOWER = label_lut([4, 13, 9, 12, 16, 17, 18, 19])
+PARSE_ARMS = {14: label_lut([14]), 15: label_lut([15])}
+
+# cv2 drawing functions take integer coordinates; with this shift they are fixed-point with 4 fractional bits.
+FIXED_POINT_SHIFT = 4
+
+
+def to_fixed_point(points):
+    fixed = np.round(np.asarray(points, dtype=np.float64) * (1 << FIXED_POINT_SHIFT)).astype(np.int32)
+    return tuple(fixed) if fixed.ndim == 1 else fixed
+
+
+def draw_segment(mask, p0, p1, width):
+    # Filled rectangle of the given width around p0-p1, with flat ends like ImageDraw.line.
+    direction = np.asarray(p1, dtype=np.float64) - p0
+    length = np.hypot(direction[0], direction[1])
+    if length == 0:
+        return
+    normal = np.array([-direction[1], direction[0]]) / length * (width - 1) / 2
+    cv2.fillConvexPoly(mask, to_fixed_point([p0 + normal, p0 - normal, p1 - normal, p1 + normal]), 255,
+                       cv2.LINE_8, FIXED_POINT_SHIFT)
+
+
+def draw_ellipse(mask, center, radius_x, radius_y=None):
+    if radius_y is None:
+        radius_y = radius_x
+    cv2.ellipse(mask, to_fixed_point(center), to_fixed_point([radius_x, radius_y]),
+                0, 0, 360, 255, -1, cv2.LINE_8, FIXED_POINT_SHIFT)
+
+
+def read_pairs(list_path):
+    pairs = []
+    with open(list_path, 'r') as f:
+        for line in f.readlines():
+            if line.strip():
+                img_name, c_name = line.strip().split()
+                pairs.append((img_name, c_name))
+    return pairs
+
 
 class VITONDataset(data.Dataset):
-    def __init__(self, opt):
+    def __init__(self, opt, pairs=None, cloth_cache=None):
         super(VITONDataset, self).__init__()
         self.load_height = opt.load_height
         self.load_width = opt.load_width
         self.semantic_nc = opt.semantic_nc
+        self.agnostic_impl = opt.agnostic_impl
         self.data_path = osp.join(opt.dataset_dir, opt.dataset_mode)
         self.transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
         ])
 
-        # load data list
+        # load data list (explicit (img_name, c_name) pairs take precedence over the list file)
+        if pairs is None:
+            pairs = read_pairs(osp.join(opt.dataset_dir, opt.dataset_list))
         img_names = []
         c_names = []
-        with open(osp.join(opt.dataset_dir, opt.dataset_list), 'r') as f:
-            for line in f.readlines():
-                img_name, c_name = line.strip().split()
-                img_names.append(img_name)
-                c_names.append(c_name)
+        for img_name, c_name in pairs:
+            img_names.append(img_name)
+            c_names.append(c_name)
 
         self.img_names = img_names
         self.c_names = dict()
         self.c_names['unpaired'] = c_names
 
-    def get_parse_agnostic(self, parse, pose_data):
+        self.cloth_cache = cloth_cache
+        self.person_cache = None
+        if opt.person_cache:
+            self.person_cache = PersonCache(osp.join(self.data_path, 'person-cache', self.agnostic_impl),
+                                            self.data_path, self.load_height, self.load_width)
+
+    def get_parse_agnostic(self, parse, pose_data, scale=1.0):
+        parse_array = np.array(parse)
+        r = 10 * scale
+
+        # mask arms: only the arm label inside the drawn limb area is removed
+        removed = cv2.LUT(parse_array, PARSE_UPPER_AND_NECK)
+        for parse_id, pose_ids in [(14, [2, 5, 6, 7]), (15, [5, 2, 3, 4])]:
+            mask_arm = np.zeros((self.load_height, self.load_width), dtype=np.uint8)
+            i_prev = pose_ids[0]
+            for i in pose_ids[1:]:
+                if (pose_data[i_prev, 0] == 0.0 and pose_data[i_prev, 1] == 0.0) or (pose_data[i, 0] == 0.0 and pose_data[i, 1] == 0.0):
+                    continue
+                draw_segment(mask_arm, pose_data[i_prev], pose_data[i], r*10)
+                draw_ellipse(mask_arm, pose_data[i], r*4 if i == pose_ids[-1] else r*15)
+                i_prev = i
+            cv2.bitwise_or(removed, cv2.bitwise_and(mask_arm, cv2.LUT(parse_array, PARSE_ARMS[parse_id])), removed)
+
+        return cv2.bitwise_and(parse_array, cv2.bitwise_not(removed))
+
+    def get_parse_agnostic_pil(self, parse, pose_data, scale=1.0):
         parse_array = np.array(parse)
         parse_upper = ((parse_array == 5).astype(np.float32) +
                        (parse_array == 6).astype(np.float32) +
                        (parse_array == 7).astype(np.float32))
         parse_neck = (parse_array == 10).astype(np.float32)
 
-        r = 10
+        r = 10 * scale
         agnostic = parse.copy()
 
         # mask arms
@@ -51,7 +147,7 @@ class VITONDataset(data.Dataset):
             for i in pose_ids[1:]:
                 if (pose_data[i_prev, 0] == 0.0 and pose_data[i_prev, 1] == 0.0) or (pose_data[i, 0] == 0.0 and pose_data[i, 1] == 0.0):
                     continue
-                mask_arm_draw.line([tuple(pose_data[j]) for j in [i_prev, i]], 'white', width=r*10)
+                mask_arm_draw.line([tuple(pose_data[j]) for j in [i_prev, i]], 'white', width=round(r*10))
                 pointx, pointy = pose_data[i]
                 radius = r*4 if i == pose_ids[-1] else r*15
                 mask_arm_draw.ellipse((pointx-radius, pointy-radius, pointx+radius, pointy+radius), 'white', 'white')
@@ -65,7 +161,47 @@ class VITONDataset(data.Dataset):
 
         return agnostic
 
-    def get_img_agnostic(self, img, parse, pose_data):
+    def get_img_agnostic(self, img, parse, pose_data, scale=1.0):
+        parse_array = np.array(parse)
+        r = 20 * scale
+        pose_data = pose_data.copy()
+        mask = np.zeros((self.load_height, self.load_width), dtype=np.uint8)
+
+        length_a = np.linalg.norm(pose_data[5] - pose_data[2])
+        length_b = np.linalg.norm(pose_data[12] - pose_data[9])
+        point = (pose_data[9] + pose_data[12]) / 2
+        pose_data[9] = point + (pose_data[9] - point) / length_b * length_a
+        pose_data[12] = point + (pose_data[12] - point) / length_b * length_a
+
+        # mask arms
+        draw_segment(mask, pose_data[2], pose_data[5], r*10)
+        for i in [2, 5]:
+            draw_ellipse(mask, pose_data[i], r*5)
+        for i in [3, 4, 6, 7]:
+            if (pose_data[i - 1, 0] == 0.0 and pose_data[i - 1, 1] == 0.0) or (pose_data[i, 0] == 0.0 and pose_data[i, 1] == 0.0):
+                continue
+            draw_segment(mask, pose_data[i - 1], pose_data[i], r*10)
+            draw_ellipse(mask, pose_data[i], r*5)
+
+        # mask torso
+        for i in [9, 12]:
+            draw_ellipse(mask, pose_data[i], r*3, r*6)
+        draw_segment(mask, pose_data[2], pose_data[9], r*6)
+        draw_segment(mask, pose_data[5], pose_data[12], r*6)
+        draw_segment(mask, pose_data[9], pose_data[12], r*12)
+        cv2.fillPoly(mask, [to_fixed_point(pose_data[[2, 5, 12, 9]])], 255, cv2.LINE_8, FIXED_POINT_SHIFT)
+
+        # mask neck
+        cv2.rectangle(mask, to_fixed_point(pose_data[1] - r*7), to_fixed_point(pose_data[1] + r*7), 255, -1,
+                      cv2.LINE_8, FIXED_POINT_SHIFT)
+
+        # head and lower body are always kept
+        cv2.bitwise_and(mask, cv2.bitwise_not(cv2.LUT(parse_array, PARSE_HEAD_AND_LOWER)), mask)
+        agnostic = np.array(img)
+        cv2.copyTo(np.full_like(agnostic, 128), mask, agnostic)
+        return agnostic
+
+    def get_img_agnostic_pil(self, img, parse, pose_data, scale=1.0):
         parse_array = np.array(parse)
         parse_head = ((parse_array == 4).astype(np.float32) +
                       (parse_array == 13).astype(np.float32))
@@ -76,7 +212,7 @@ class VITONDataset(data.Dataset):
                        (parse_array == 18).astype(np.float32) +
                        (parse_array == 19).astype(np.float32))
 
-        r = 20
+        r = 20 * scale
         agnostic = img.copy()
         agnostic_draw = ImageDraw.Draw(agnostic)
 
@@ -87,14 +223,14 @@ class VITONDataset(data.Dataset):
         pose_data[12] = point + (pose_data[12] - point) / length_b * length_a
 
         # mask arms
-        agnostic_draw.line([tuple(pose_data[i]) for i in [2, 5]], 'gray', width=r*10)
+        agnostic_draw.line([tuple(pose_data[i]) for i in [2, 5]], 'gray', width=round(r*10))
         for i in [2, 5]:
             pointx, pointy = pose_data[i]
             agnostic_draw.ellipse((pointx-r*5, pointy-r*5, pointx+r*5, pointy+r*5), 'gray', 'gray')
         for i in [3, 4, 6, 7]:
             if (pose_data[i - 1, 0] == 0.0 and pose_data[i - 1, 1] == 0.0) or (pose_data[i, 0] == 0.0 and pose_data[i, 1] == 0.0):
                 continue
-            agnostic_draw.line([tuple(pose_data[j]) for j in [i - 1, i]], 'gray', width=r*10)
+            agnostic_draw.line([tuple(pose_data[j]) for j in [i - 1, i]], 'gray', width=round(r*10))
             pointx, pointy = pose_data[i]
             agnostic_draw.ellipse((pointx-r*5, pointy-r*5, pointx+r*5, pointy+r*5), 'gray', 'gray')
 
@@ -102,9 +238,9 @@ class VITONDataset(data.Dataset):
         for i in [9, 12]:
             pointx, pointy = pose_data[i]
             agnostic_draw.ellipse((pointx-r*3, pointy-r*6, pointx+r*3, pointy+r*6), 'gray', 'gray')
-        agnostic_draw.line([tuple(pose_data[i]) for i in [2, 9]], 'gray', width=r*6)
-        agnostic_draw.line([tuple(pose_data[i]) for i in [5, 12]], 'gray', width=r*6)
-        agnostic_draw.line([tuple(pose_data[i]) for i in [9, 12]], 'gray', width=r*12)
+        agnostic_draw.line([tuple(pose_data[i]) for i in [2, 9]], 'gray', width=round(r*6))
+        agnostic_draw.line([tuple(pose_data[i]) for i in [5, 12]], 'gray', width=round(r*6))
+        agnostic_draw.line([tuple(pose_data[i]) for i in [9, 12]], 'gray', width=round(r*12))
         agnostic_draw.polygon([tuple(pose_data[i]) for i in [2, 5, 12, 9]], 'gray', 'gray')
 
         # mask neck
@@ -115,80 +251,101 @@ class VITONDataset(data.Dataset):
 
         return agnostic
 
-    def __getitem__(self, index):
-        img_name = self.img_names[index]
-        c_name = {}
-        c = {}
-        cm = {}
-        for key in self.c_names:
-            c_name[key] = self.c_names[key][index]
-            c[key] = Image.open(osp.join(self.data_path, 'cloth', c_name[key])).convert('RGB')
-            c[key] = transforms.Resize(self.load_width, interpolation=2)(c[key])
-            cm[key] = Image.open(osp.join(self.data_path, 'cloth-mask', c_name[key]))
-            cm[key] = transforms.Resize(self.load_width, interpolation=0)(cm[key])
-
-            c[key] = self.transform(c[key])  # [-1,1]
-            cm_array = np.array(cm[key])
-            cm_array = (cm_array >= 128).astype(np.float32)
-            cm[key] = torch.from_numpy(cm_array)  # [0,1]
-            cm[key].unsqueeze_(0)
+    def get_cloth(self, c_name):
+        c = Image.open(osp.join(self.data_path, 'cloth', c_name)).convert('RGB')
+        c = transforms.Resize(self.load_width, interpolation=2)(c)
+        cm = Image.open(osp.join(self.data_path, 'cloth-mask', c_name))
+        cm = transforms.Resize(self.load_width, interpolation=0)(cm)
 
+        c = self.transform(c)  # [-1,1]
+        cm_array = np.array(cm)
+        cm_array = (cm_array >= 128).astype(np.float32)
+        cm = torch.from_numpy(cm_array)  # [0,1]
+        cm.unsqueeze_(0)
+        return c, cm
+
+    def get_person(self, img_name):
         # load pose image
-        pose_name = img_name.replace('.jpg', '_rendered.png')
-        pose_rgb = Image.open(osp.join(self.data_path, 'openpose-img', pose_name))
-        pose_rgb = transforms.Resize(self.load_width, interpolation=2)(pose_rgb)
-        pose_rgb = self.transform(pose_rgb)  # [-1,1]
-
-        pose_name = img_name.replace('.jpg', '_keypoints.json')
-        with open(osp.join(self.data_path, 'openpose-json', pose_name), 'r') as f:
-            pose_label = json.load(f)
-            pose_data = pose_label['people'][0]['pose_keypoints_2d']
-            pose_data = np.array(pose_data)
-            pose_data = pose_data.reshape((-1, 3))[:, :2]
+        with PROFILER.stage('dataset/pose_img'):
+            pose_name = img_name.replace('.jpg', '_rendered.png')
+            pose_rgb = Image.open(osp.join(self.data_path, 'openpose-img', pose_name))
+            # the keypoints and the agnostic mask sizes are in pixels of the original images (768 wide)
+            scale = self.load_width / pose_rgb.size[0]
+            pose_rgb = transforms.Resize(self.load_width, interpolation=2)(pose_rgb)
+            pose_rgb = self.transform(pose_rgb)  # [-1,1]
+
+        with PROFILER.stage('dataset/pose_json'):
+            pose_name = img_name.replace('.jpg', '_keypoints.json')
+            with open(osp.join(self.data_path, 'openpose-json', pose_name), 'r') as f:
+                pose_label = json.load(f)
+                pose_data = pose_label['people'][0]['pose_keypoints_2d']
+                pose_data = np.array(pose_data)
+                pose_data = pose_data.reshape((-1, 3))[:, :2] * scale
 
         # load parsing image
-        parse_name = img_name.replace('.jpg', '.png')
-        parse = Image.open(osp.join(self.data_path, 'image-parse', parse_name))
-        parse = transforms.Resize(self.load_width, interpolation=0)(parse)
-        parse_agnostic = self.get_parse_agnostic(parse, pose_data)
-        parse_agnostic = torch.from_numpy(np.array(parse_agnostic)[None]).long()
-
-        labels = {
-            0: ['background', [0, 10]],
-            1: ['hair', [1, 2]],
-            2: ['face', [4, 13]],
-            3: ['upper', [5, 6, 7]],
-            4: ['bottom', [9, 12]],
-            5: ['left_arm', [14]],
-            6: ['right_arm', [15]],
-            7: ['left_leg', [16]],
-            8: ['right_leg', [17]],
-            9: ['left_shoe', [18]],
-            10: ['right_shoe', [19]],
-            11: ['socks', [8]],
-            12: ['noise', [3, 11]]
-        }
-        parse_agnostic_map = torch.zeros(20, self.load_height, self.load_width, dtype=torch.float)
-        parse_agnostic_map.scatter_(0, parse_agnostic, 1.0)
-        new_parse_agnostic_map = torch.zeros(self.semantic_nc, self.load_height, self.load_width, dtype=torch.float)
-        for i in range(len(labels)):
-            for label in labels[i][1]:
-                new_parse_agnostic_map[i] += parse_agnostic_map[label]
+        with PROFILER.stage('dataset/parse_agnostic'):
+            parse_name = img_name.replace('.jpg', '.png')
+            parse = Image.open(osp.join(self.data_path, 'image-parse', parse_name))
+            parse = transforms.Resize(self.load_width, interpolation=0)(parse)
+            if self.agnostic_impl == 'pil':
+                parse_agnostic = self.get_parse_agnostic_pil(parse, pose_data, scale)
+            else:
+                parse_agnostic = self.get_parse_agnostic(parse, pose_data, scale)
+            parse_agnostic = torch.from_numpy(np.array(parse_agnostic)[None]).long()
+            new_parse_agnostic_map = remap_one_hot(parse_agnostic, PARSE_AGNOSTIC_LUT, self.semantic_nc)
 
         # load person image
-        img = Image.open(osp.join(self.data_path, 'image', img_name))
-        img = transforms.Resize(self.load_width, interpolation=2)(img)
-        img_agnostic = self.get_img_agnostic(img, parse, pose_data)
-        img = self.transform(img)
-        img_agnostic = self.transform(img_agnostic)  # [-1,1]
-
-        result = {
-            'img_name': img_name,
-            'c_name': c_name,
+        with PROFILER.stage('dataset/img_agnostic'):
+            img = Image.open(osp.join(self.data_path, 'image', img_name))
+            img = transforms.Resize(self.load_width, interpolation=2)(img)
+            if self.agnostic_impl == 'pil':
+                img_agnostic = self.get_img_agnostic_pil(img, parse, pose_data, scale)
+            else:
+                img_agnostic = self.get_img_agnostic(img, parse, pose_data, scale)
+            img = self.transform(img)
+            img_agnostic = self.transform(img_agnostic)  # [-1,1]
+
+        return {
             'img': img,
             'img_agnostic': img_agnostic,
             'parse_agnostic': new_parse_agnostic_map,
             'pose': pose_rgb,
+        }
+
+    def load_cloth(self, c_name):
+        if self.cloth_cache is not None:
+            return self.cloth_cache.get_cloth(c_name, self.get_cloth)
+        return self.get_cloth(c_name)
+
+    def load_person(self, img_name):
+        # the person side does not depend on the cloth, so it can come from the precomputed cache
+        if self.person_cache is not None:
+            return self.person_cache.get(img_name, self.get_person)
+        return self.get_person(img_name)
+
+    def __getitem__(self, index):
+        with PROFILER.stage('dataset'):
+            return self.get_item(index)
+
+    def get_item(self, index):
+        img_name = self.img_names[index]
+        c_name = {}
+        c = {}
+        cm = {}
+        with PROFILER.stage('dataset/cloth_io'):
+            for key in self.c_names:
+                c_name[key] = self.c_names[key][index]
+                c[key], cm[key] = self.load_cloth(c_name[key])
+
+        with PROFILER.stage('dataset/person'):
+            person = self.load_person(img_name)
+        result = {
+            'img_name': img_name,
+            'c_name': c_name,
+            'img': person['img'],
+            'img_agnostic': person['img_agnostic'],
+            'parse_agnostic': person['parse_agnostic'],
+            'pose': person['pose'],
             'cloth': c,
             'cloth_mask': cm,
         }
@@ -209,7 +366,7 @@ class VITONDataLoader:
 
         self.data_loader = data.DataLoader(
                 dataset, batch_size=opt.batch_size, shuffle=(train_sampler is None),
-                num_workers=opt.workers, pin_memory=True, drop_last=True, sampler=train_sampler
+                num_workers=opt.workers, pin_memory=True, drop_last=False, sampler=train_sampler
         )
         self.dataset = dataset
         self.data_iter = self.data_loader.__iter__()
@@ -0,0 +1,148 @@
+import copy
+import os
+import warnings
+
+import torch
+from torch import nn
+
+from backends import GRAPHS, graph_path, load_exported_networks, write_metadata
+from networks import ALIASNorm
+from test import get_parser, load_networks
+
+
+class MethodModule(nn.Module):
+    # a method of a network as the forward of a module, to trace it on its own; `names` are its keyword arguments
+    def __init__(self, module, method, names):
+        super(MethodModule, self).__init__()
+        self.module = module
+        self.method = method
+        self.names = names
+
+    def forward(self, *inputs):
+        return getattr(self.module, self.method)(**dict(zip(self.names, inputs)))
+
+
+class ExplicitNoise(nn.Module):
+    # ALIASGenerator taking the noise of its norms as trailing inputs (see ALIASGenerator.forward)
+    def __init__(self, alias):
+        super(ExplicitNoise, self).__init__()
+        self.alias = alias
+
+    def forward(self, x, seg, seg_div, misalign_mask, *noise):
+        return self.alias(x, seg, seg_div, misalign_mask, noise)
+
+
+@torch.no_grad()
+def alias_noise_sizes(alias, inputs):
+    """(w, h, 1) of the noise of every ALIASNorm, in call order, recorded on one forward."""
+    sizes = []
+
+    def record(norm, args):
+        sizes.append([args[0].size(3), args[0].size(2), 1])
+
+    handles = [module.register_forward_pre_hook(record) for module in alias.modules() if isinstance(module, ALIASNorm)]
+    try:
+        alias(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sizes
+
+
+@torch.no_grad()
+def export_cases(opt, seg, gmm, alias, noise_sizes, batch_size=1):
+    """{graph: (module, example inputs, input names)}, the inputs of the shapes the try-on pipeline feeds them."""
+    h, w = opt.load_height, opt.load_width
+    b = batch_size
+    inputB = torch.randn(b, 3, 256, 192)
+    parse = torch.rand(b, 7, h, w)
+    misalign_mask = (torch.rand(b, 1, h, w) > 0.9).float()
+    alias_inputs = (torch.randn(b, 9, h, w), parse, torch.cat((parse, misalign_mask), dim=1), misalign_mask)
+    noise = tuple(torch.randn(b, *size) for size in noise_sizes)
+    return {
+        'seg': (seg, (torch.randn(b, opt.semantic_nc + 8, 256, 192),), ['seg_input']),
+        'gmm_cloth': (MethodModule(gmm, 'encode_cloth', ['inputB']), (inputB,), ['inputB']),
+        'gmm_theta': (MethodModule(gmm, 'compute_theta', ['inputA', 'featureB']),
+                      (torch.randn(b, 7, 256, 192), gmm.encode_cloth(inputB)), ['inputA', 'featureB']),
+        'tps': (gmm.gridGen, (torch.randn(b, 2 * opt.grid_size**2) * 0.05,), ['theta']),
+        'alias': (ExplicitNoise(alias), alias_inputs + noise,
+                  ['x', 'seg', 'seg_div', 'misalign_mask'] + ['noise_{}'.format(i) for i in range(len(noise))]),
+    }
+
+
+def export_torchscript(module, inputs, path):
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(module.eval(), inputs, check_trace=False))
+    traced.save(path)
+
+
+def export_onnx(module, inputs, input_names, path):
+    # the legacy (TorchScript-based) exporter, which traces like export_torchscript; the batch size stays dynamic
+    with torch.no_grad():
+        torch.onnx.export(module.eval(), inputs, path, input_names=input_names, output_names=['output'],
+                          dynamic_axes={name: {0: 'batch_' + name} for name in input_names}, opset_version=17,
+                          dynamo=False)
+
+
+def export_graphs(opt, cases, backend):
+    for graph in GRAPHS:
+        module, inputs, input_names = cases[graph]
+        path = graph_path(opt, graph, backend)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # tracer warnings about Python values becoming constants
+            if backend == 'torchscript':
+                export_torchscript(module, inputs, path)
+            else:
+                export_onnx(module, inputs, input_names, path)
+        print("saved {}".format(path))
+
+
+def check_backend(opt, cases, backend):
+    """Max abs difference between the outputs of each eager network and its graph loaded by `backend`."""
+    backend_opt = copy.copy(opt)
+    backend_opt.backend = backend
+    seg, gmm, alias = load_exported_networks(backend_opt)
+    graphs = {'seg': seg, 'gmm_cloth': gmm.extractionB, 'gmm_theta': gmm.theta, 'tps': gmm.gridGen.graph,
+              'alias': alias.graph}
+    differences = {}
+    with torch.no_grad():
+        for graph, (module, inputs, _) in cases.items():
+            differences[graph] = (module(*inputs) - graphs[graph](*inputs)).abs().max().item()
+    return differences
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--export_formats', nargs='+', choices=['torchscript', 'onnxruntime'],
+                        default=['torchscript', 'onnxruntime'])
+    opt = parser.parse_args()
+    # the graphs are traced from the frozen fp32 networks
+    opt.freeze, opt.quantize, opt.precision, opt.backend = True, False, [], 'eager'
+
+    if not os.path.exists(opt.export_dir):
+        os.makedirs(opt.export_dir)
+    seg, gmm, alias = load_networks(opt)
+    h, w = opt.load_height, opt.load_width
+    parse = torch.rand(1, 7, h, w)
+    noise_sizes = alias_noise_sizes(alias, (torch.randn(1, 9, h, w), parse, torch.cat((parse, parse[:, :1]), dim=1),
+                                            parse[:, :1]))
+    cases = export_cases(opt, seg, gmm, alias, noise_sizes)
+    write_metadata(opt, noise_sizes)
+
+    for backend in opt.export_formats:
+        try:
+            export_graphs(opt, cases, backend)
+        except (ImportError, torch.onnx.OnnxExporterError) as e:
+            print("{} export skipped: {}".format(backend, e))
+            continue
+        try:
+            differences = check_backend(opt, cases, backend)
+        except ImportError as e:
+            print("{} not checked: {}".format(backend, e))
+            continue
+        print("{}: max abs difference to eager: {}".format(backend, ', '.join(
+            '{} {:.2e}'.format(graph, diff) for graph, diff in differences.items())))
+
+
+if __name__ == '__main__':
+    main()
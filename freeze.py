@@ -0,0 +1,77 @@
+import copy
+import os
+import time
+
+import torch
+
+from test import derived_checkpoint_path, get_parser, load_networks
+
+
+def equivalence_cases(opt, batch_size=1):
+    """{network: fn(net)} running each network on random inputs of the shapes the try-on pipeline feeds it."""
+    h, w = opt.load_height, opt.load_width
+    seg_input = torch.randn(batch_size, opt.semantic_nc + 8, 256, 192)
+    gmm_inputs = (torch.randn(batch_size, 7, 256, 192), torch.randn(batch_size, 3, 256, 192))
+    parse = torch.rand(batch_size, 7, h, w)
+    misalign_mask = (torch.rand(batch_size, 1, h, w) > 0.9).float()
+    alias_inputs = (torch.randn(batch_size, 9, h, w), parse, torch.cat((parse, misalign_mask), dim=1), misalign_mask)
+    return {
+        'seg': lambda seg: seg(seg_input),
+        'gmm': lambda gmm: gmm.compute_theta(*gmm_inputs),
+        'alias': lambda alias: alias(*alias_inputs),
+    }
+
+
+@torch.no_grad()
+def check_equivalence(opt, networks, frozen_networks, seed=0):
+    """
+    Runs the original and the frozen networks on the same random inputs (and noise).
+
+    Returns:
+        dict: {network: (max abs difference of the outputs, original seconds, frozen seconds)}.
+    """
+    results = {}
+    for (name, fn), net, frozen_net in zip(equivalence_cases(opt).items(), networks, frozen_networks):
+        outputs = []
+        seconds = []
+        for candidate in (net, frozen_net):
+            torch.manual_seed(seed)
+            start = time.perf_counter()
+            outputs.append(fn(candidate))
+            seconds.append(time.perf_counter() - start)
+        results[name] = ((outputs[0] - outputs[1]).abs().max().item(), seconds[0], seconds[1])
+    return results
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest difference between the original and the frozen outputs accepted')
+    opt = parser.parse_args()
+    opt.freeze = opt.quantize = False  # the original checkpoints are the reference
+
+    networks = load_networks(opt)
+    frozen_networks = [copy.deepcopy(net) for net in networks]
+    for name, net in zip(['seg', 'gmm', 'alias'], frozen_networks):
+        counts = net.freeze_for_inference()
+        print("{}: baked {} spectral norm(s), folded {} batch norm(s)".format(
+            name, counts['spectral_norm'], counts['batch_norm']))
+
+    print("{:<6} | {:>12} | {:>11} | {:>9}".format('net', 'max abs diff', 'original ms', 'frozen ms'))
+    failed = []
+    for name, (diff, seconds, frozen_seconds) in check_equivalence(opt, networks, frozen_networks).items():
+        print("{:<6} | {:12.2e} | {:11.1f} | {:9.1f}".format(name, diff, seconds * 1000, frozen_seconds * 1000))
+        if not diff <= opt.tolerance:
+            failed.append(name)
+    if failed:
+        raise SystemExit("the frozen {} differ(s) from the original by more than {}".format(
+            ', '.join(failed), opt.tolerance))
+
+    for net, checkpoint in zip(frozen_networks, (opt.seg_checkpoint, opt.gmm_checkpoint, opt.alias_checkpoint)):
+        frozen_path = derived_checkpoint_path(os.path.join(opt.checkpoint_dir, checkpoint), '_frozen')
+        torch.save(net.state_dict(), frozen_path)
+        print("saved {}".format(frozen_path))
+
+
+if __name__ == '__main__':
+    main()
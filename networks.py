@@ -3,7 +3,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.nn import init
-from torch.nn.utils.spectral_norm import spectral_norm
+from torch.ao import quantization
+from torch.ao.nn.intrinsic import ConvReLU2d
+from torch.nn.utils.spectral_norm import SpectralNormLoadStateDictPreHook, remove_spectral_norm, spectral_norm
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -48,10 +50,108 @@ class BaseNetwork(nn.Module):
 
         self.apply(init_func)
 
+    def freeze_for_inference(self):
+        """
+        Turns the network into an equivalent, cheaper inference-only network: switches to eval mode, bakes every
+        spectral_norm into a plain weight (computed as in eval mode, without power iteration) and folds every
+        eval-mode BatchNorm2d directly following a Conv2d in an nn.Sequential into the convolution. BatchNorms after
+        an activation are kept: folding them into the next, zero-padded convolution would change its borders. The
+        gamma and beta convolutions of every ALIASNorm are merged into one (see ALIASNorm.merge_gamma_beta).
+
+        The frozen network has a different state dict (see freeze.py for saving and test.load_networks for loading
+        it) and can no longer be trained.
+
+        Returns:
+            dict: The # of baked spectral norms and folded batch norms.
+        """
+        self.eval()
+        counts = {'spectral_norm': 0, 'batch_norm': 0}
+        for module in list(self.modules()):
+            if hasattr(module, 'weight_orig'):
+                bake_spectral_norm(module)
+                counts['spectral_norm'] += 1
+            if isinstance(module, ALIASNorm):
+                module.merge_gamma_beta()
+            if isinstance(module, nn.Sequential):
+                for i in range(1, len(module)):
+                    if isinstance(module[i - 1], nn.Conv2d) and isinstance(module[i], nn.BatchNorm2d) and \
+                            module[i].track_running_stats:
+                        fold_batch_norm(module[i - 1], module[i])
+                        module[i] = nn.Identity()
+                        counts['batch_norm'] += 1
+        self.requires_grad_(False)
+        return counts
+
+    def int8_scope(self):
+        # the submodules whose convolutions prepare_int8 quantizes
+        return [self]
+
+    def prepare_int8(self, backend='x86'):
+        """
+        First step of int8 post-training static quantization (torch.ao eager mode). Freezes the network (see
+        freeze_for_inference), wraps every Conv2d of `int8_scope()` between a QuantStub and a DeQuantStub, fused with
+        the ReLU directly following it in an nn.Sequential, and inserts observers recording the ranges of their inputs
+        and outputs. Run calibration inputs through the network, then call convert_int8. Everything else
+        (normalizations, interpolations, concatenations, the noise) stays fp32, each convolution quantizing its input
+        and dequantizing its output.
+
+        Like a frozen one, the quantized network has its own state dict (see quantize.py for saving and
+        test.load_networks for loading it).
+        """
+        self.freeze_for_inference()
+        qconfig = quantization.get_default_qconfig(backend)
+        for scope in self.int8_scope():
+            for module in list(scope.modules()):
+                wrap_int8_convs(module, qconfig)
+            quantization.prepare(scope, inplace=True)
+
+    def convert_int8(self):
+        # swaps the observed convolutions for quantized ones (see prepare_int8)
+        for scope in self.int8_scope():
+            quantization.convert(scope, inplace=True)
+
     def forward(self, *inputs):
         pass
 
 
+def bake_spectral_norm(module):
+    remove_spectral_norm(module)
+    # remove_spectral_norm misses its load_state_dict pre-hook (the module registers it wrapped), which would still
+    # require the weight_orig and weight_u keys when loading a frozen state dict
+    for key, hook in list(module._load_state_dict_pre_hooks.items()):
+        if isinstance(getattr(hook, 'hook', hook), SpectralNormLoadStateDictPreHook):
+            del module._load_state_dict_pre_hooks[key]
+
+
+@torch.no_grad()
+def fold_batch_norm(conv, bn):
+    # bn(conv(x)) = conv(x) * scale + shift per output channel, with scale = gamma / sqrt(running_var + eps)
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift * bn.weight + bn.bias
+        scale = scale * bn.weight
+    if conv.bias is None:
+        conv.bias = nn.Parameter(torch.zeros_like(scale))
+    conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+    conv.bias.mul_(scale).add_(shift)
+
+
+def wrap_int8_convs(module, qconfig):
+    # QuantStub -> Conv2d (or ConvReLU2d) -> DeQuantStub for every Conv2d child; a ReLU fused into the convolution
+    # leaves an nn.Identity in its place
+    children = list(module.named_children())
+    for i, (name, child) in enumerate(children):
+        if type(child) is not nn.Conv2d:
+            continue
+        if isinstance(module, nn.Sequential) and i + 1 < len(children) and isinstance(children[i + 1][1], nn.ReLU):
+            child = ConvReLU2d(child, children[i + 1][1])
+            setattr(module, children[i + 1][0], nn.Identity())
+        wrapped = nn.Sequential(quantization.QuantStub(), child, quantization.DeQuantStub())
+        wrapped.qconfig = qconfig
+        setattr(module, name, wrapped)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 #                                              SegGenerator-related classes
 # ----------------------------------------------------------------------------------------------------------------------
@@ -149,10 +249,10 @@ class FeatureCorrelation(nn.Module):
         # Reshape features for matrix multiplication.
         b, c, h, w = featureA.size()
         featureA = featureA.permute(0, 3, 2, 1).reshape(b, w * h, c)
-        featureB = featureB.reshape(b, c, h * w)
+        featureB = featureB.reshape(featureB.size(0), c, h * w)
 
-        # Perform matrix multiplication.
-        corr = torch.bmm(featureA, featureB).reshape(b, w * h, h, w)
+        # Perform matrix multiplication (a single featureB is broadcast against the whole batch).
+        corr = torch.matmul(featureA, featureB).reshape(b, w * h, h, w)
         return corr
 
 
@@ -176,12 +276,18 @@ class FeatureRegression(nn.Module):
 
 
 class TpsGridGen(nn.Module):
-    def __init__(self, opt, dtype=torch.float):
+    def __init__(self, opt, dtype=torch.float, grid_factor=1):
         super(TpsGridGen, self).__init__()
 
+        # The warp is a smooth field, so it can be evaluated on a grid `grid_factor` times coarser than the output and
+        # bilinearly upsampled (see forward).
+        self.out_height, self.out_width = opt.load_height, opt.load_width
+        self.grid_factor = grid_factor
+        grid_height, grid_width = opt.load_height // grid_factor, opt.load_width // grid_factor
+
         # Create a grid in numpy.
         # TODO: set an appropriate interval ([-1, 1] in CP-VTON, [-0.9, 0.9] in the current version of VITON-HD)
-        grid_X, grid_Y = np.meshgrid(np.linspace(-0.9, 0.9, opt.load_width), np.linspace(-0.9, 0.9, opt.load_height))
+        grid_X, grid_Y = np.meshgrid(np.linspace(-0.9, 0.9, grid_width), np.linspace(-0.9, 0.9, grid_height))
         grid_X = torch.tensor(grid_X, dtype=dtype).unsqueeze(0).unsqueeze(3)  # size: (1, h, w, 1)
         grid_Y = torch.tensor(grid_Y, dtype=dtype).unsqueeze(0).unsqueeze(3)  # size: (1, h, w, 1)
 
@@ -196,6 +302,9 @@ class TpsGridGen(nn.Module):
         P_Y_base = P_Y.clone()
 
         Li = self.compute_L_inverse(P_X, P_Y).unsqueeze(0)
+        # The grid and the control points are constant, so the radial basis of the grid w.r.t. P is computed once;
+        # warping the grid then reduces to a single matmul with the per-sample TPS coefficients.
+        basis = self.compute_basis(grid_X.reshape(-1), grid_Y.reshape(-1), P_X_base, P_Y_base)  # size: (h*w, N+3)
         P_X = P_X.unsqueeze(2).unsqueeze(3).unsqueeze(4).transpose(0, 4)  # size: (1, 1, 1, 1, self.N)
         P_Y = P_Y.unsqueeze(2).unsqueeze(3).unsqueeze(4).transpose(0, 4)  # size: (1, 1, 1, 1, self.N)
 
@@ -206,8 +315,12 @@ class TpsGridGen(nn.Module):
         self.register_buffer('Li', Li, False)
         self.register_buffer('P_X', P_X, False)
         self.register_buffer('P_Y', P_Y, False)
+        self.register_buffer('basis', basis, False)
+        # bases of the other output sizes requested from forward(), built on first use
+        self.bases = {}
 
     # TODO: refactor
+    @torch.autocast('cpu', enabled=False)  # the inverse of L is ill-conditioned in reduced precision
     def compute_L_inverse(self,X,Y):
         N = X.size()[0] # num of points (along dim 0)
         # construct matrix K
@@ -224,7 +337,16 @@ class TpsGridGen(nn.Module):
         Li = torch.inverse(L)
         return Li
 
+    def compute_basis(self, points_X, points_Y, P_X, P_Y):
+        # U(|p - P_i|) for every point p and control point P_i, followed by the affine terms (1, x, y)
+        dist_squared = (points_X[:, None] - P_X.t()) ** 2 + (points_Y[:, None] - P_Y.t()) ** 2
+        dist_squared[dist_squared == 0] = 1  # avoid NaN in log computation
+        U = dist_squared * torch.log(dist_squared)
+        return torch.cat((U, torch.ones_like(points_X)[:, None], points_X[:, None], points_Y[:, None]), 1)
+
     # TODO: refactor
+    # Reference implementation for arbitrary points; forward() uses the precomputed basis of the regular grid instead,
+    # which avoids materializing [B, H, W, 1, N] tensors.
     def apply_transformation(self,theta,points):
         if theta.dim()==2:
             theta = theta.unsqueeze(2).unsqueeze(3)
@@ -301,29 +423,68 @@ class TpsGridGen(nn.Module):
 
         return torch.cat((points_X_prime,points_Y_prime),3)
 
-    def forward(self, theta):
-        warped_grid = self.apply_transformation(theta, torch.cat((self.grid_X, self.grid_Y), 3))
+    def grid_basis(self, height, width):
+        if (height, width) == (self.grid_X.size(1), self.grid_X.size(2)):
+            return self.basis
+        if (height, width) not in self.bases:
+            grid_X, grid_Y = np.meshgrid(np.linspace(-0.9, 0.9, width), np.linspace(-0.9, 0.9, height))
+            grid_X = torch.tensor(grid_X, dtype=self.basis.dtype).reshape(-1)
+            grid_Y = torch.tensor(grid_Y, dtype=self.basis.dtype).reshape(-1)
+            self.bases[(height, width)] = self.compute_basis(grid_X, grid_Y, self.P_X_base, self.P_Y_base)
+        return self.bases[(height, width)]
+
+    @torch.autocast('cpu', enabled=False)  # grid coordinates need more than the 8 bits of a bfloat16 mantissa
+    def forward(self, theta, size=None):
+        # `size` overrides the output size given at construction, e.g. for previews rendered at a lower resolution.
+        out_height, out_width = size if size is not None else (self.out_height, self.out_width)
+        b, h, w = theta.size(0), out_height // self.grid_factor, out_width // self.grid_factor
+        theta = theta.float().reshape(b, 2, self.N).transpose(1, 2)  # size: (b, N, 2), columns are the X and Y offsets
+        Q = theta + torch.cat((self.P_X_base, self.P_Y_base), 1)
+        coefficients = torch.matmul(self.Li[:, :, :self.N], Q)  # size: (b, N+3, 2)
+        warped_grid = torch.matmul(self.grid_basis(h, w), coefficients)  # size: (b, h*w, 2)
+        warped_grid = warped_grid.reshape(b, h, w, 2)
+
+        if (h, w) != (out_height, out_width):
+            # Both grids span [-0.9, 0.9] end to end, so with align_corners=True every output point is interpolated
+            # at exactly its own position in the coarse grid
+            # (interpolating a channels-last tensor with 2 channels is several times slower, hence the contiguous()).
+            warped_grid = F.interpolate(warped_grid.permute(0, 3, 1, 2).contiguous(), size=(out_height, out_width),
+                                        mode='bilinear', align_corners=True).permute(0, 2, 3, 1)
         return warped_grid
 
 
-class GMM(nn.Module):
+class GMM(BaseNetwork):
     def __init__(self, opt, inputA_nc, inputB_nc):
         super(GMM, self).__init__()
 
         self.extractionA = FeatureExtraction(inputA_nc, ngf=64, num_layers=4)
         self.extractionB = FeatureExtraction(inputB_nc, ngf=64, num_layers=4)
         self.correlation = FeatureCorrelation()
-        self.regression = FeatureRegression(input_nc=(opt.load_width // 64) * (opt.load_height // 64),
-                                            output_size=2 * opt.grid_size**2)
-        self.gridGen = TpsGridGen(opt)
+        # The GMM always sees 256x192 inputs, whatever the load size; its features are 16 times smaller.
+        self.regression = FeatureRegression(input_nc=(256 // 16) * (192 // 16), output_size=2 * opt.grid_size**2)
+        self.gridGen = TpsGridGen(opt, grid_factor=opt.warp_grid_factor)
 
-    def forward(self, inputA, inputB):
+    def int8_scope(self):
+        # the regression, whose output is the TPS parameters, stays fp32
+        return [self.extractionA, self.extractionB]
+
+    def encode_cloth(self, inputB):
+        return F.normalize(self.extractionB(inputB), dim=1)
+
+    def compute_theta(self, inputA, inputB=None, featureB=None):
+        # featureB (the output of encode_cloth) can be precomputed once per cloth and reused; with a batch size of 1
+        # it is shared by every sample of inputA.
         featureA = F.normalize(self.extractionA(inputA), dim=1)
-        featureB = F.normalize(self.extractionB(inputB), dim=1)
+        if featureB is None:
+            featureB = self.encode_cloth(inputB)
         corr = self.correlation(featureA, featureB)
-        theta = self.regression(corr)
+        return self.regression(corr)
 
-        warped_grid = self.gridGen(theta)
+    def forward(self, inputA, inputB=None, featureB=None, size=None):
+        # `size` is the size of the warped grid (default: the load size); the same theta can be turned into grids of
+        # other sizes with gridGen.
+        theta = self.compute_theta(inputA, inputB, featureB)
+        warped_grid = self.gridGen(theta, size)
         return theta, warped_grid
 
 
@@ -336,7 +497,9 @@ class MaskNorm(nn.Module):
 
         self.norm_layer = nn.InstanceNorm2d(norm_nc, affine=False)
 
+    @torch.autocast('cpu', enabled=False)  # the sums and divisions by pixel counts run in fp32
     def normalize_region(self, region, mask):
+        region, mask = region.float(), mask.float()
         b, c, h, w = region.size()
 
         num_pixels = mask.sum((2, 3), keepdim=True)  # size: (b, 1, 1, 1)
@@ -378,11 +541,41 @@ class ALIASNorm(nn.Module):
         self.conv_shared = nn.Sequential(nn.Conv2d(label_nc, nhidden, kernel_size=ks, padding=pw), nn.ReLU())
         self.conv_gamma = nn.Conv2d(nhidden, norm_nc, kernel_size=ks, padding=pw)
         self.conv_beta = nn.Conv2d(nhidden, norm_nc, kernel_size=ks, padding=pw)
-
-    def forward(self, x, seg, misalign_mask=None):
-        # Part 1. Generate parameter-free normalized activations.
+        # Set by merge_gamma_beta (see test.load_networks and freeze_for_inference), never during a forward pass.
+        self.conv_gamma_beta = None
+
+    def merge_gamma_beta(self):
+        # conv_gamma and conv_beta read the same activations, so for inference they are replaced with a single Conv2d
+        # module with both weights concatenated, computing gamma and beta in one convolution (and quantized as one,
+        # see prepare_int8). The merged norm has a state dict of its own, but still loads the separate convolutions'
+        # parameters (see _load_from_state_dict). Does nothing if already merged.
+        if self.conv_gamma_beta is not None:
+            return
+        merged = nn.Conv2d(self.conv_gamma.in_channels, 2 * self.conv_gamma.out_channels,
+                           kernel_size=self.conv_gamma.kernel_size, padding=self.conv_gamma.padding)
+        merged.weight.data = torch.cat((self.conv_gamma.weight.data, self.conv_beta.weight.data))
+        merged.bias.data = torch.cat((self.conv_gamma.bias.data, self.conv_beta.bias.data))
+        merged.requires_grad_(self.conv_gamma.weight.requires_grad)
+        del self.conv_gamma, self.conv_beta
+        self.conv_gamma_beta = merged
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # a merged norm loads the conv_gamma/conv_beta parameters of a checkpoint saved before merging, concatenated
+        if self.conv_gamma_beta is not None:
+            for name in ('weight', 'bias'):
+                gamma_key, beta_key = prefix + 'conv_gamma.' + name, prefix + 'conv_beta.' + name
+                if gamma_key in state_dict and beta_key in state_dict:
+                    state_dict[prefix + 'conv_gamma_beta.' + name] = torch.cat((state_dict.pop(gamma_key),
+                                                                                state_dict.pop(beta_key)))
+        super(ALIASNorm, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, seg, misalign_mask=None, noise=None):
+        # Part 1. Generate parameter-free normalized activations. `noise` is unit Gaussian noise of size (b, w, h, 1),
+        # drawn here if not given.
         b, c, h, w = x.size()
-        noise = (torch.randn(b, w, h, 1).cpu() * self.noise_scale).transpose(1, 3)
+        if noise is None:
+            noise = torch.randn(b, w, h, 1).cpu()
+        noise = (noise * self.noise_scale).transpose(1, 3)
 
         if misalign_mask is None:
             normalized = self.param_free_norm(x + noise)
@@ -390,13 +583,27 @@ class ALIASNorm(nn.Module):
             normalized = self.param_free_norm(x + noise, misalign_mask)
 
         # Part 2. Produce affine parameters conditioned on the segmentation map.
+        # The 2-3 norms of an ALIASResBlock read the same segmentation map, but their conv_shared are not batched
+        # into one convolution with concatenated weights: that measured only ~5% faster, while tripling this
+        # activation at the output level (+0.8 GB at 1024x768).
         actv = self.conv_shared(seg)
-        gamma = self.conv_gamma(actv)
-        beta = self.conv_beta(actv)
+        if self.conv_gamma_beta is not None:
+            gamma, beta = self.conv_gamma_beta(actv).chunk(2, dim=1)
+        else:
+            gamma = self.conv_gamma(actv)
+            beta = self.conv_beta(actv)
 
         # Apply the affine parameters.
-        output = normalized * (1 + gamma) + beta
-        return output
+        if torch.is_grad_enabled():
+            output = normalized * (1 + gamma) + beta
+            return output
+        # Inference: in place, without the (1 + gamma) and product temporaries
+        return normalized.mul_(gamma.add_(1)).add_(beta)
+
+
+def next_noise(noise):
+    # None lets the ALIASNorm draw its own noise
+    return None if noise is None else next(noise)
 
 
 class ALIASResBlock(nn.Module):
@@ -431,21 +638,24 @@ class ALIASResBlock(nn.Module):
 
         self.relu = nn.LeakyReLU(0.2)
 
-    def shortcut(self, x, seg, misalign_mask):
+    def shortcut(self, x, seg, misalign_mask, noise=None):
         if self.learned_shortcut:
-            return self.conv_s(self.norm_s(x, seg, misalign_mask))
+            return self.conv_s(self.norm_s(x, seg, misalign_mask, next_noise(noise)))
         else:
             return x
 
-    def forward(self, x, seg, misalign_mask=None):
-        seg = F.interpolate(seg, size=x.size()[2:], mode='nearest')
-        if misalign_mask is not None:
+    def forward(self, x, seg, misalign_mask=None, noise=None):
+        # `noise`: None, or an iterator over the noise of the norms, in call order (see ALIASGenerator.forward)
+        # ALIASGenerator passes the conditioning maps already at the size of x
+        if seg.size()[2:] != x.size()[2:]:
+            seg = F.interpolate(seg, size=x.size()[2:], mode='nearest')
+        if misalign_mask is not None and misalign_mask.size()[2:] != x.size()[2:]:
             misalign_mask = F.interpolate(misalign_mask, size=x.size()[2:], mode='nearest')
 
-        x_s = self.shortcut(x, seg, misalign_mask)
+        x_s = self.shortcut(x, seg, misalign_mask, noise)
 
-        dx = self.conv_0(self.relu(self.norm_0(x, seg, misalign_mask)))
-        dx = self.conv_1(self.relu(self.norm_1(dx, seg, misalign_mask)))
+        dx = self.conv_0(self.relu(self.norm_0(x, seg, misalign_mask, next_noise(noise))))
+        dx = self.conv_1(self.relu(self.norm_1(dx, seg, misalign_mask, next_noise(noise))))
         output = x_s + dx
         return output
 
@@ -454,8 +664,7 @@ class ALIASGenerator(BaseNetwork):
     def __init__(self, opt, input_nc):
         super(ALIASGenerator, self).__init__()
         self.num_upsampling_layers = opt.num_upsampling_layers
-
-        self.sh, self.sw = self.compute_latent_vector_size(opt)
+        self.num_up_layers = self.compute_num_up_layers()
 
         nf = opt.ngf
         self.conv_0 = nn.Conv2d(input_nc, nf * 16, kernel_size=3, padding=1)
@@ -484,43 +693,76 @@ class ALIASGenerator(BaseNetwork):
         self.print_network()
         self.init_weights(opt.init_type, opt.init_variance)
 
-    def compute_latent_vector_size(self, opt):
+    def compute_num_up_layers(self):
         if self.num_upsampling_layers == 'normal':
-            num_up_layers = 5
+            return 5
         elif self.num_upsampling_layers == 'more':
-            num_up_layers = 6
+            return 6
         elif self.num_upsampling_layers == 'most':
-            num_up_layers = 7
+            return 7
         else:
             raise ValueError("opt.num_upsampling_layers '{}' is not recognized".format(self.num_upsampling_layers))
 
-        sh = opt.load_height // 2**num_up_layers
-        sw = opt.load_width // 2**num_up_layers
-        return sh, sw
-
-    def forward(self, x, seg, seg_div, misalign_mask):
-        samples = [F.interpolate(x, size=(self.sh * 2**i, self.sw * 2**i), mode='nearest') for i in range(8)]
+    def compute_level_sizes(self, height, width):
+        # The sizes of the 8 levels follow the input, so the same weights render at any resolution: level
+        # `num_up_layers` is the output size and the latent is halved from it (1024x768 -> 8x6, 512x384 -> 4x3),
+        # rounding up where the size is not a multiple of 2**num_up_layers (256x192 -> 2x2).
+        sizes = [(height, width)]
+        while len(sizes) <= self.num_up_layers:
+            sizes.insert(0, ((sizes[0][0] + 1) // 2, (sizes[0][1] + 1) // 2))
+        while len(sizes) < 8:
+            sizes.append((sizes[-1][0] * 2, sizes[-1][1] * 2))
+        return sizes
+
+    def forward(self, x, seg, seg_div, misalign_mask, noise=None):
+        # `noise` optionally gives the unit Gaussian noise of every ALIASNorm, in call order, instead of drawing it in
+        # each norm (torch.randn, in the same order), which makes it an explicit input of an exported graph
+        if noise is not None:
+            noise = iter(noise)
+        sizes = self.compute_level_sizes(x.size(2), x.size(3))
+        samples = [F.interpolate(x, size=sizes[i], mode='nearest') for i in range(8)]
         features = [self._modules['conv_{}'.format(i)](samples[i]) for i in range(8)]
 
-        x = self.head_0(features[0], seg_div, misalign_mask)
+        def up(x, i):
+            # same as self.up (nearest, x2) where the sizes are exact multiples
+            return F.interpolate(x, size=sizes[i], mode='nearest')
+
+        # The conditioning maps at the size of each block, resized (nearest) from the full-size maps once per forward
+        # and shared by the blocks at the same size; maps already at the right size are used as they are.
+        pyramid = {}
 
-        x = self.up(x)
-        x = self.G_middle_0(torch.cat((x, features[1]), 1), seg_div, misalign_mask)
+        def at_size_of(x, name, m):
+            size = x.size()[2:]
+            if (name, size) not in pyramid:
+                pyramid[name, size] = m if m.size()[2:] == size else F.interpolate(m, size=size, mode='nearest')
+            return pyramid[name, size]
+
+        def seg_div_level(x):
+            return at_size_of(x, 'seg_div', seg_div), at_size_of(x, 'misalign_mask', misalign_mask)
+
+        x = features[0]
+        x = self.head_0(x, *seg_div_level(x), noise=noise)
+
+        x = torch.cat((up(x, 1), features[1]), 1)
+        x = self.G_middle_0(x, *seg_div_level(x), noise=noise)
         if self.num_upsampling_layers in ['more', 'most']:
-            x = self.up(x)
-        x = self.G_middle_1(torch.cat((x, features[2]), 1), seg_div, misalign_mask)
-
-        x = self.up(x)
-        x = self.up_0(torch.cat((x, features[3]), 1), seg_div, misalign_mask)
-        x = self.up(x)
-        x = self.up_1(torch.cat((x, features[4]), 1), seg_div, misalign_mask)
-        x = self.up(x)
-        x = self.up_2(torch.cat((x, features[5]), 1), seg)
-        x = self.up(x)
-        x = self.up_3(torch.cat((x, features[6]), 1), seg)
+            x = up(x, 2)
+        x = torch.cat((x, features[2]), 1)
+        x = self.G_middle_1(x, *seg_div_level(x), noise=noise)
+
+        x = torch.cat((up(x, 3), features[3]), 1)
+        x = self.up_0(x, *seg_div_level(x), noise=noise)
+        x = torch.cat((up(x, 4), features[4]), 1)
+        x = self.up_1(x, *seg_div_level(x), noise=noise)
+        x = torch.cat((up(x, 5), features[5]), 1)
+        x = self.up_2(x, at_size_of(x, 'seg', seg), noise=noise)
+        x = torch.cat((up(x, 6), features[6]), 1)
+        x = self.up_3(x, at_size_of(x, 'seg', seg), noise=noise)
         if self.num_upsampling_layers == 'most':
-            x = self.up(x)
-            x = self.up_4(torch.cat((x, features[7]), 1), seg)
+            x = torch.cat((up(x, 7), features[7]), 1)
+            x = self.up_4(x, at_size_of(x, 'seg', seg), noise=noise)
 
-        x = self.conv_img(self.relu(x))
-        return self.tanh(x)
+        # the output layer and tanh run in fp32 whatever the autocast precision, as the image is quantized to 8 bits
+        with torch.autocast('cpu', enabled=False):
+            x = self.conv_img(self.relu(x.float()))
+            return self.tanh(x)
@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# end of stream marker passed down the queues
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def new_stage_stats():
+    # busy: running the stage's own work; wait_in/wait_out: blocked on an empty input or a full output queue
+    return {'items': 0, 'busy': 0.0, 'wait_in': 0.0, 'wait_out': 0.0}
+
+
+def _put(output_queue, item, stop):
+    # blocks while the queue is full, but gives up (returning False) once `stop` is set
+    while not stop.is_set():
+        try:
+            output_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _load(source, output_queue, stats, stop):
+    items = iter(source)
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            item = next(items, _END)
+            stats['busy'] += time.perf_counter() - start
+            if item is _END:
+                break
+            start = time.perf_counter()
+            if not _put(output_queue, item, stop):
+                break
+            stats['wait_out'] += time.perf_counter() - start
+            stats['items'] += 1
+        _put(output_queue, _END, stop)
+    except Exception as e:
+        _put(output_queue, _Failure(e), stop)
+    finally:
+        # a generator source is closed right away; a DataLoader iterator shuts its worker processes down once this
+        # thread, its last reference, ends
+        if hasattr(items, 'close'):
+            items.close()
+
+
+def _save(input_queue, sink, stats, errors):
+    while True:
+        start = time.perf_counter()
+        item = input_queue.get()
+        stats['wait_in'] += time.perf_counter() - start
+        if item is _END:
+            break
+        if errors:
+            continue  # keep draining, so the main thread never blocks on a full queue
+        start = time.perf_counter()
+        try:
+            sink(item)
+        except Exception as e:
+            errors.append(e)
+        stats['busy'] += time.perf_counter() - start
+        stats['items'] += 1
+
+
+def run_pipeline(source, process, sink, load_depth=2, save_depth=2):
+    """
+    Runs `sink(process(item))` for every item of `source` as three overlapping stages connected by bounded queues.
+
+    The source is iterated on a loader thread and the sink runs on a saver thread, while `process` runs on the
+    calling thread, so the next item is loaded and the previous result saved while the current one is processed
+    (torch, PIL and OpenCV release the GIL in their heavy parts). The queue depths bound how many items the loader
+    can run ahead and how many results can wait for the saver. An exception in any stage is re-raised here, once the
+    loader has stopped and the saver has finished.
+
+    Args:
+        source (iterable): Items to process, e.g. a DataLoader.
+        process (callable): Called on the calling thread with each item.
+        sink (callable): Called on the saver thread with each result of `process`.
+        load_depth (int): Maximum # of loaded items waiting for `process`.
+        save_depth (int): Maximum # of results waiting for `sink`.
+
+    Returns:
+        OrderedDict: {'load' | 'process' | 'save': stats} with the # of items and the busy and waiting seconds of each
+            stage, plus {'wall': seconds}.
+    """
+    stats = OrderedDict((name, new_stage_stats()) for name in ('load', 'process', 'save'))
+    load_queue = queue.Queue(maxsize=max(1, load_depth))
+    save_queue = queue.Queue(maxsize=max(1, save_depth))
+    errors = []
+    stop = threading.Event()
+    loader = threading.Thread(target=_load, args=(source, load_queue, stats['load'], stop), daemon=True)
+    saver = threading.Thread(target=_save, args=(save_queue, sink, stats['save'], errors), daemon=True)
+
+    wall_start = time.perf_counter()
+    loader.start()
+    saver.start()
+    try:
+        while not errors:
+            start = time.perf_counter()
+            item = load_queue.get()
+            stats['process']['wait_in'] += time.perf_counter() - start
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+
+            start = time.perf_counter()
+            result = process(item)
+            stats['process']['busy'] += time.perf_counter() - start
+            stats['process']['items'] += 1
+
+            start = time.perf_counter()
+            save_queue.put(result)
+            stats['process']['wait_out'] += time.perf_counter() - start
+    finally:
+        # stops the loader (which may be blocked on a full queue, if `process` or `sink` failed) before returning
+        stop.set()
+        while loader.is_alive():
+            try:
+                load_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        loader.join()
+        save_queue.put(_END)
+        saver.join()
+    if errors:
+        raise errors[0]
+    stats['wall'] = time.perf_counter() - wall_start
+    return stats
+
+
+def print_pipeline_stats(stats):
+    # utilization: share of the wall time a stage spent on its own work
+    wall = stats['wall']
+    print("{:<8} | {:>5} | {:>8} | {:>9} | {:>10} | {:>11}".format(
+        'stage', 'items', 'busy s', 'wait in s', 'wait out s', 'utilization'))
+    for name, stage in stats.items():
+        if name == 'wall':
+            continue
+        print("{:<8} | {:5d} | {:8.2f} | {:9.2f} | {:10.2f} | {:10.1%}".format(
+            name, stage['items'], stage['busy'], stage['wait_in'], stage['wait_out'],
+            stage['busy'] / max(wall, 1e-9)))
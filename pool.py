@@ -0,0 +1,180 @@
+import copy
+import os
+import queue
+import time
+import traceback
+
+import cv2
+import torch
+from torch import multiprocessing as mp
+
+from datasets import VITONDataset, VITONDataLoader, read_pairs
+from test import get_parser, iter_tryon, load_networks, make_cloth_cache, preview_opt, print_throughput
+from utils import save_images
+
+# longest the parent waits for a message before checking again that every worker is still alive
+POLL_INTERVAL = 1.0
+
+
+def split_threads(num_cores, num_workers, intra_threads=0):
+    """Intra-op threads per worker: `intra_threads` if given, else an even share of the cores (at least 1)."""
+    if intra_threads > 0:
+        return intra_threads
+    return max(1, num_cores // num_workers)
+
+
+def _worker(worker_id, opt, networks, intra_threads, tasks, results, generation):
+    # The networks were inherited from the parent through fork, their weights in shared memory.
+    torch.set_num_threads(intra_threads)
+    cv2.setNumThreads(intra_threads)
+    opt = copy.copy(opt)
+    opt.workers = 0  # daemonic processes cannot start DataLoader workers
+    cloth_cache = make_cloth_cache(opt)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        run_id, task_id, pairs = task
+        if run_id != generation.value:
+            continue  # the run was cancelled (see TryOnPool.cancel)
+        try:
+            loader = VITONDataLoader(opt, VITONDataset(opt, pairs=pairs, cloth_cache=cloth_cache))
+            start = time.perf_counter()
+            for output, unpaired_names in iter_tryon(opt, *networks, loader.data_loader, cloth_cache):
+                save_images(output, unpaired_names, opt.save_dir)
+                results.put(('images', worker_id, run_id, task_id, unpaired_names, time.perf_counter() - start))
+                if run_id != generation.value:
+                    break
+                start = time.perf_counter()
+            results.put(('done', worker_id, run_id, task_id, None, None))
+        except Exception:
+            results.put(('error', worker_id, run_id, task_id, traceback.format_exc(), None))
+
+
+class TryOnPool:
+    """
+    Process pool of warm seg/gmm/alias replicas for data-parallel CPU inference.
+
+    The networks are loaded once in the parent and moved to shared memory with `share_memory()` before the workers
+    are forked, so the N replicas map the same weight pages instead of holding N copies. `run` splits the
+    (person, cloth) pairs into chunks that idle workers take from a queue, and every worker runs the try-on pipeline
+    on its chunks with `intra_threads` intra-op threads (torch and OpenCV), saving the outputs to opt.save_dir itself.
+
+    If a chunk fails, or a worker dies without reporting it (e.g. killed by the OOM killer), `run` raises a
+    RuntimeError and cancels the chunks of the run still queued, which the workers then skip.
+
+    The parent should not have run any multi-threaded op before the fork: the OpenMP thread pool of a forked child
+    is not usable, which is why main() pins the parent to one thread before loading the networks.
+    """
+
+    def __init__(self, opt, seg, gmm, alias, num_workers, intra_threads):
+        self.opt = opt
+        self.num_workers = num_workers
+        self.intra_threads = intra_threads
+        for net in (seg, gmm, alias):
+            net.share_memory()
+
+        ctx = mp.get_context('fork')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        # id of the current run; the tasks and results of older (cancelled) runs are skipped
+        self.generation = ctx.Value('i', 0)
+        self.workers = []
+        for worker_id in range(num_workers):
+            worker = ctx.Process(target=_worker, args=(worker_id, opt, (seg, gmm, alias), intra_threads, self.tasks,
+                                                       self.results, self.generation), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def run(self, pairs, chunk_size=1, display_freq=0):
+        """Renders every pair; returns the number of images, the wall time and the # of images of each worker."""
+        run_id = self.generation.value
+        chunks = [pairs[k:k + chunk_size] for k in range(0, len(pairs), chunk_size)]
+        for task_id, chunk in enumerate(chunks):
+            self.tasks.put((run_id, task_id, chunk))
+
+        per_worker = [0] * self.num_workers
+        num_images = 0
+        pending = len(chunks)
+        start = time.time()
+        try:
+            while pending:
+                self.check_workers()
+                try:
+                    kind, worker_id, result_run_id, task_id, payload, seconds = self.results.get(
+                        timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if result_run_id != run_id:
+                    continue  # left over from a cancelled run
+                if kind == 'error':
+                    raise RuntimeError("worker {} failed on chunk {}:\n{}".format(worker_id, task_id, payload))
+                if kind == 'done':
+                    pending -= 1
+                    continue
+                per_worker[worker_id] += len(payload)
+                num_images += len(payload)
+                if display_freq and num_images % display_freq == 0:
+                    print("images: {} (worker {}, {:.2f}s)".format(num_images, worker_id, seconds))
+        except BaseException:
+            self.cancel()
+            raise
+        return num_images, time.time() - start, per_worker
+
+    def check_workers(self):
+        for worker_id, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                raise RuntimeError("worker {} (pid {}) died with exit code {}".format(worker_id, worker.pid,
+                                                                                    worker.exitcode))
+
+    def cancel(self):
+        # the chunks of the current run still queued are skipped, and the workers stop the ones they are rendering
+        # after their current batch
+        with self.generation.get_lock():
+            self.generation.value += 1
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+def shared_weight_bytes(*nets):
+    return sum(t.numel() * t.element_size() for net in nets for t in list(net.parameters()) + list(net.buffers()))
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--pool_workers', type=int, default=os.cpu_count(), help='# of worker processes')
+    parser.add_argument('--intra_threads', type=int, default=0,
+                        help='intra-op threads per worker (0: the cores divided evenly between the workers)')
+    parser.add_argument('--chunk_size', type=int, default=0,
+                        help='# of pairs handed to a worker at a time (0: --batch_size)')
+    opt = parser.parse_args()
+    opt = preview_opt(opt, opt.preview_scale)
+    print(opt)
+
+    if not os.path.exists(opt.save_dir):
+        os.makedirs(opt.save_dir)
+
+    torch.set_num_threads(1)  # see TryOnPool
+    seg, gmm, alias = load_networks(opt)
+    intra_threads = split_threads(os.cpu_count(), opt.pool_workers, opt.intra_threads)
+    pool = TryOnPool(opt, seg, gmm, alias, opt.pool_workers, intra_threads)
+    print("pool: {} worker(s) x {} intra-op thread(s), {:.1f} MB of shared weights".format(
+        opt.pool_workers, intra_threads, shared_weight_bytes(seg, gmm, alias) / 2**20))
+
+    try:
+        pairs = read_pairs(os.path.join(opt.dataset_dir, opt.dataset_list))
+        num_images, seconds, per_worker = pool.run(pairs, opt.chunk_size or opt.batch_size, opt.display_freq)
+    finally:
+        pool.close()
+    print("images per worker: {}".format(per_worker))
+    print_throughput(num_images, seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import copy
+import time
+
+from quantize import load_batches, render
+from test import STAGES, get_parser, load_networks, match_memory_format, stage_precision
+from utils import psnr, ssim
+
+# policies compared when --precision is not given: each stage alone in bf16, then all of them
+DEFAULT_POLICIES = [[(stage, 'bf16')] for stage in STAGES] + [[('all', 'bf16')]]
+
+
+def policy_name(opt):
+    return ' '.join('{}={}'.format(stage, stage_precision(opt, stage)) for stage in STAGES)
+
+
+def timed_render(opt, networks, batches):
+    match_memory_format(opt, *networks)
+    render(opt, networks, batches[:1])  # warm-up: the first reduced-precision call builds its kernels
+    start = time.perf_counter()
+    output = render(opt, networks, batches)
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--calibration_pairs', type=int, default=0,
+                        help='# of pairs of --dataset_list rendered for the report (0: all)')
+    opt = parser.parse_args()
+    policies = [opt.precision] if opt.precision else DEFAULT_POLICIES
+
+    networks = load_networks(opt)
+    batches = load_batches(opt, opt.calibration_pairs)
+    num_images = sum(len(inputs['img_name']) for inputs in batches)
+
+    reference_opt = copy.copy(opt)
+    reference_opt.precision = []
+    reference, reference_seconds = timed_render(reference_opt, networks, batches)
+    print("{} image(s) of {}".format(num_images, opt.dataset_list))
+    print("{:<32} | {:>9} | {:>7} | {:>9} | {:>6}".format('precision', 'ms/image', 'speedup', 'PSNR dB', 'SSIM'))
+    print("{:<32} | {:9.1f} | {:>7} | {:>9} | {:>6}".format(policy_name(reference_opt),
+                                                            reference_seconds * 1000 / num_images, '', '', ''))
+    for policy in policies:
+        policy_opt = copy.copy(opt)
+        policy_opt.precision = policy
+        output, seconds = timed_render(policy_opt, networks, batches)
+        print("{:<32} | {:9.1f} | {:6.2f}x | {:9.2f} | {:6.4f}".format(
+            policy_name(policy_opt), seconds * 1000 / num_images, reference_seconds / seconds,
+            psnr(output, reference), ssim(output, reference)))
+
+
+if __name__ == '__main__':
+    main()
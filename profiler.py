@@ -0,0 +1,174 @@
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+from networks import ALIASResBlock
+
+
+def current_rss():
+    """Resident set size of the process, in bytes."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # no procfs: fall back to the peak so far
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler:
+    """
+    Opt-in stage timer recording the wall time, CPU time and peak RSS of named, possibly nested, stages.
+
+    Stages are opened with `with profiler.stage('name'):` or attached to the forward calls of a module with
+    `instrument`. While the profiler is disabled, `stage` returns a no-op context and instrumented modules only pay for
+    a flag check. A background thread samples the RSS every `sample_interval` seconds, so the peak of a stage includes
+    the transient allocations freed before it ends. CPU time is process-wide, i.e. it includes the intra-op threads.
+    """
+
+    def __init__(self, sample_interval=0.005):
+        self.enabled = False
+        self.sample_interval = sample_interval
+        self.events = []
+        self.open_events = []
+        self.origin = time.perf_counter()
+        self.sampler = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def sample(self):
+        while self.enabled:
+            rss = current_rss()
+            for event in list(self.open_events):
+                event['peak_rss'] = max(event['peak_rss'], rss)
+            time.sleep(self.sample_interval)
+
+    def begin(self, name):
+        rss = current_rss()
+        tid = threading.get_ident()
+        event = {
+            'name': name,
+            # nesting within the thread: stages of other threads (e.g. of a pipeline) overlap without being nested
+            'depth': sum(1 for event in self.open_events if event['tid'] == tid),
+            'tid': tid,
+            'start': time.perf_counter() - self.origin,
+            'cpu_start': time.process_time(),
+            'rss_start': rss,
+            'peak_rss': rss,
+        }
+        self.open_events.append(event)
+        return event
+
+    def end(self, event):
+        rss = current_rss()
+        self.open_events.remove(event)
+        event['wall'] = time.perf_counter() - self.origin - event['start']
+        event['cpu'] = time.process_time() - event.pop('cpu_start')
+        event['rss_end'] = rss
+        event['peak_rss'] = max(event['peak_rss'], rss)
+        self.events.append(event)
+
+    def stage(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self.record(name)
+
+    @contextmanager
+    def record(self, name):
+        event = self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(event)
+
+    def instrument(self, module, name):
+        """Records every forward call of `module` as the stage `name`."""
+        pending = []
+
+        def pre_hook(module, inputs):
+            if self.enabled:
+                pending.append(self.begin(name))
+
+        def hook(module, inputs, output):
+            if pending:
+                self.end(pending.pop())
+
+        module.register_forward_pre_hook(pre_hook)
+        module.register_forward_hook(hook)
+
+    def summary(self):
+        """Per-stage totals, in order of first appearance."""
+        stages = OrderedDict()
+        for event in sorted(self.events, key=lambda event: event['start']):
+            stage = stages.setdefault(event['name'], {'depth': event['depth'], 'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                      'peak_rss': 0, 'peak_growth': 0})
+            stage['calls'] += 1
+            stage['wall'] += event['wall']
+            stage['cpu'] += event['cpu']
+            stage['peak_rss'] = max(stage['peak_rss'], event['peak_rss'])
+            stage['peak_growth'] = max(stage['peak_growth'], event['peak_rss'] - event['rss_start'])
+        return stages
+
+    def print_summary(self):
+        print("{:<28} | {:>5} | {:>11} | {:>10} | {:>11} | {:>12} | {:>14}".format(
+            'stage', 'calls', 'wall ms', 'mean ms', 'cpu ms', 'peak RSS MB', 'peak growth MB'))
+        for name, stage in self.summary().items():
+            print("{:<28} | {:5d} | {:11.1f} | {:10.2f} | {:11.1f} | {:12.1f} | {:14.1f}".format(
+                '  ' * stage['depth'] + name, stage['calls'], stage['wall'] * 1000, stage['wall'] * 1000 / stage['calls'],
+                stage['cpu'] * 1000, stage['peak_rss'] / 2**20, stage['peak_growth'] / 2**20))
+
+    def save_jsonl(self, path):
+        """One JSON object per stage call; times in seconds, memory in bytes."""
+        with open(path, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + '\n')
+
+    def save_chrome_trace(self, path):
+        """Complete ('X') events in the Chrome trace format, for chrome://tracing or Perfetto."""
+        trace = []
+        for event in self.events:
+            trace.append({
+                'name': event['name'],
+                'ph': 'X',
+                'ts': event['start'] * 1e6,
+                'dur': event['wall'] * 1e6,
+                'pid': os.getpid(),
+                'tid': event['tid'],
+                'args': {
+                    'cpu_ms': event['cpu'] * 1000,
+                    'peak_rss_mb': event['peak_rss'] / 2**20,
+                    'peak_growth_mb': (event['peak_rss'] - event['rss_start']) / 2**20,
+                },
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+# Process-wide profiler used by the dataset and the try-on pipeline; disabled unless --profile is given.
+PROFILER = Profiler()
+
+
+def instrument_networks(profiler, seg, gmm, alias):
+    # the try-on pipeline calls GMM.compute_theta and gridGen directly, so the 'gmm' stage is opened by test.warp
+    profiler.instrument(seg, 'seg')
+    for name in ['extractionA', 'extractionB', 'correlation', 'regression', 'gridGen']:
+        if hasattr(gmm, name):  # the exported GMM (see backends.py) has no extractionA, correlation and regression
+            profiler.instrument(getattr(gmm, name), 'gmm/{}'.format(name))
+    profiler.instrument(alias, 'alias')
+    for name, module in alias.named_children():
+        if isinstance(module, ALIASResBlock):
+            profiler.instrument(module, 'alias/{}'.format(name))
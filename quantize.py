@@ -0,0 +1,98 @@
+import copy
+import os
+import time
+import warnings
+
+import cv2
+import torch
+
+from datasets import VITONDataset, VITONDataLoader, read_pairs
+from freeze import equivalence_cases
+from test import derived_checkpoint_path, get_parser, load_networks, tryon_batch
+from utils import psnr, ssim
+
+def load_batches(opt, num_pairs=0):
+    # the first `num_pairs` pairs of the list (0: all of them), loaded once in a fixed order
+    pairs = read_pairs(os.path.join(opt.dataset_dir, opt.dataset_list))
+    if num_pairs > 0:
+        pairs = pairs[:num_pairs]
+    opt = copy.copy(opt)
+    opt.workers = 0
+    return list(VITONDataLoader(opt, VITONDataset(opt, pairs=pairs)).data_loader)
+
+
+@torch.no_grad()
+def render(opt, networks, batches, seed=0):
+    # the try-on outputs of every batch, with the same noise (torch and OpenCV) whatever the networks
+    outputs = []
+    for i, inputs in enumerate(batches):
+        torch.manual_seed(seed + i)
+        cv2.setRNGSeed(seed + i)
+        outputs.append(tryon_batch(opt, *networks, inputs)[0])
+    return torch.cat(outputs)
+
+
+@torch.no_grad()
+def latency(fn, net, repeat=3):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(net)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def quantize_networks(opt, networks, batches):
+    """
+    Int8 copies of the networks: prepared (see BaseNetwork.prepare_int8), calibrated by running `batches` through the
+    whole try-on pipeline, so every convolution observes the activations it sees in use, and converted.
+    """
+    int8_networks = [copy.deepcopy(net) for net in networks]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # torch.ao.quantization deprecation notices
+        for net in int8_networks:
+            net.prepare_int8()
+        render(opt, int8_networks, batches)
+        for net in int8_networks:
+            net.convert_int8()
+    return int8_networks
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--calibration_pairs', type=int, default=0,
+                        help='# of pairs of --dataset_list run for calibration and the quality report (0: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='the latency of a network is its best of this # of runs')
+    opt = parser.parse_args()
+    # the frozen fp32 networks are calibrated and are the reference, so the speedups are those of int8 alone
+    opt.freeze, opt.quantize = True, False
+
+    networks = list(load_networks(opt))
+    batches = load_batches(opt, opt.calibration_pairs)
+    print("calibrating on {} batch(es) of {}".format(len(batches), opt.dataset_list))
+    int8_networks = quantize_networks(opt, networks, batches)
+
+    # Latency of each network on its own, on inputs of the pipeline's shapes; quality of the try-on output with only
+    # that network in int8 (and with all three) against the fp32 output, on the calibration pairs.
+    reference = render(opt, networks, batches)
+    print("{:<6} | {:>9} | {:>9} | {:>7} | {:>9} | {:>6}".format('net', 'fp32 ms', 'int8 ms', 'speedup', 'PSNR dB',
+                                                                 'SSIM'))
+    for i, ((name, fn), net, int8_net) in enumerate(zip(equivalence_cases(opt).items(), networks, int8_networks)):
+        fp32_seconds = latency(fn, net, opt.repeat)
+        int8_seconds = latency(fn, int8_net, opt.repeat)
+        output = render(opt, networks[:i] + [int8_net] + networks[i + 1:], batches)
+        print("{:<6} | {:9.1f} | {:9.1f} | {:6.2f}x | {:9.2f} | {:6.4f}".format(
+            name, fp32_seconds * 1000, int8_seconds * 1000, fp32_seconds / int8_seconds, psnr(output, reference),
+            ssim(output, reference)))
+    output = render(opt, int8_networks, batches)
+    print("{:<6} | {:>9} | {:>9} | {:>7} | {:9.2f} | {:6.4f}".format('all', '', '', '', psnr(output, reference),
+                                                                     ssim(output, reference)))
+
+    for net, checkpoint in zip(int8_networks, (opt.seg_checkpoint, opt.gmm_checkpoint, opt.alias_checkpoint)):
+        int8_path = derived_checkpoint_path(os.path.join(opt.checkpoint_dir, checkpoint), '_int8')
+        torch.save(net.state_dict(), int8_path)
+        print("saved {}".format(int8_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'mean': sum(values) / len(values),
+        'p50': values[(len(values) - 1) // 2],
+        'p90': values[int(0.9 * (len(values) - 1))],
+        'max': values[-1],
+    }
+
+
+class BatchScheduler:
+    """
+    Coalesces items submitted by concurrent requests into batches and runs them on a single worker thread.
+
+    `submit(key, item)` returns a Future of the item's own result. The worker takes the oldest pending item and waits
+    for more items with the same key (e.g. the load size, since only same-sized samples can be stacked) until the
+    batch holds `max_batch_size` items or the oldest one has waited `max_wait` seconds, then calls
+    `process(key, items)`, which must return one result per item, and resolves every Future with its own result (or
+    with the exception of the batch).
+
+    Args:
+        process (callable): Runs a batch: `process(key, items) -> [result, ...]`.
+        max_batch_size (int): Maximum # of items per batch.
+        max_wait (float): Maximum seconds the oldest pending item waits for the batch to fill up.
+        history (int): # of the most recent wait times kept for the metrics.
+    """
+
+    def __init__(self, process, max_batch_size=4, max_wait=0.02, history=1000):
+        self.process = process
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.pending = deque()  # (key, item, future, enqueue time)
+        self.condition = threading.Condition()
+
+        self.max_queue_depth = 0
+        self.batch_sizes = Counter()
+        self.wait_times = deque(maxlen=history)
+        self.busy = 0.0
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, key, item):
+        future = Future()
+        with self.condition:
+            self.pending.append((key, item, future, time.perf_counter()))
+            self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            self.condition.notify()
+        return future
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            key = self.pending[0][0]
+            deadline = self.pending[0][3] + self.max_wait
+            while True:
+                batch = [entry for entry in self.pending if entry[0] == key][:self.max_batch_size]
+                remaining = deadline - time.perf_counter()
+                if len(batch) == self.max_batch_size or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            for entry in batch:
+                self.pending.remove(entry)
+            return key, batch
+
+    def run(self):
+        while True:
+            key, batch = self.next_batch()
+            start = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            self.wait_times.extend(start - entry[3] for entry in batch)
+            try:
+                results = self.process(key, [entry[1] for entry in batch])
+                for entry, result in zip(batch, results):
+                    entry[2].set_result(result)
+            except Exception as e:
+                for entry in batch:
+                    entry[2].set_exception(e)
+            self.busy += time.perf_counter() - start
+
+    def stats(self):
+        """Queue depth, batch size histogram and wait times (in ms, from submission to the start of the batch)."""
+        with self.condition:
+            queue_depth = len(self.pending)
+        num_batches = sum(self.batch_sizes.values())
+        wait_times = summarize([seconds * 1000 for seconds in self.wait_times])
+        return {
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'batches': num_batches,
+            'batch_sizes': {size: self.batch_sizes[size] for size in sorted(self.batch_sizes)},
+            'mean_batch_size': sum(size * n for size, n in self.batch_sizes.items()) / num_batches if num_batches else None,
+            'wait_ms': wait_times,
+            'busy_seconds': self.busy,
+        }
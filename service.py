@@ -0,0 +1,488 @@
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path as osp
+
+import torch
+from torch.utils import data
+
+from datasets import VITONDataset, VITONDataLoader, read_pairs
+from scheduler import BatchScheduler
+from test import (get_parser, iter_tryon, iter_tryon_progressive, load_networks, make_cloth_cache, make_result_cache,
+                  output_name, preview_opt, split_cached, store_results, tryon_batch)
+from utils import generate_cloth_mask, save_images
+
+# progressive requests write their previews into this subdirectory of the job's output directory
+PREVIEW_DIR = 'preview'
+
+
+class Job:
+    """One try-on request: its own output directory, status and results."""
+
+    def __init__(self, job_id, output_dir):
+        self.id = job_id
+        self.output_dir = output_dir
+        self.status = 'queued'  # queued -> running -> done / failed / cancelled
+        self.created = time.time()
+        self.finished = None
+        self.results = []
+        self.previews = []
+        self.error = None
+        self.first_image_latency = None  # seconds from the start of the job to its first image (or preview)
+        self.latency = None  # seconds from the start of the job to its last image
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'created': self.created,
+            'finished': self.finished,
+            'results': list(self.results),
+            'previews': list(self.previews),
+            'error': self.error,
+            'first_image_latency': self.first_image_latency,
+            'latency': self.latency,
+        }
+
+
+class TryOnService:
+    """
+    Keeps SegGenerator, GMM and ALIASGenerator loaded in memory and runs try-on requests against them.
+
+    Building the networks and loading the three checkpoints happens once, in the constructor (the cold start);
+    every later request only pays for data loading and inference. Every request is a Job writing into its own
+    `<save_dir>/<job id>/` directory, so concurrent requests never see each other's results. Finished jobs are
+    garbage-collected once they are older than `job_ttl` seconds, or oldest first while their outputs take more than
+    `max_results_mb` on disk.
+
+    Unless `max_batch_size` is 0, the (person, cloth) pairs of concurrent non-progressive requests are coalesced by a
+    BatchScheduler into batches of up to `max_batch_size` samples, waiting at most `max_batch_wait` seconds for a batch
+    to fill up, which run through the networks together; every request loads its own samples and gets its own
+    outputs back.
+
+    The networks (and the cloth caches' GMM features) are shared by every request and are not thread-safe, so every
+    forward pass, whether it runs on the scheduler's worker or on a request's own thread, holds `model_lock`.
+    """
+
+    def __init__(self, opt, job_ttl=3600, max_results_mb=1024, max_concurrent_jobs=2, max_batch_size=4,
+                 max_batch_wait=0.02):
+        start = time.time()
+        self.opt = opt
+        self.data_path = osp.join(opt.dataset_dir, opt.dataset_mode)
+        os.makedirs(opt.save_dir, exist_ok=True)
+
+        self.seg, self.gmm, self.alias = load_networks(opt)
+        self.model_lock = threading.Lock()
+        # one cloth cache per preview scale, since the cached tensors are at the load size
+        self.cloth_caches = {1: make_cloth_cache(opt)}
+        self.result_cache = make_result_cache(opt)
+        self.cloth_lock = threading.Lock()
+        self.latencies = []
+        self.first_image_latencies = []
+
+        self.job_ttl = job_ttl
+        self.max_results_bytes = max_results_mb * 2**20
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs)
+        self.scheduler = None
+        if max_batch_size > 0:
+            self.scheduler = BatchScheduler(self.run_batch, max_batch_size, max_batch_wait)
+        self.cold_start = time.time() - start
+
+    @property
+    def catalogue(self):
+        """Person images listed in the dataset list, in order and without duplicates."""
+        person_ids = []
+        for img_name, _ in read_pairs(osp.join(self.opt.dataset_dir, self.opt.dataset_list)):
+            if img_name not in person_ids:
+                person_ids.append(img_name)
+        return person_ids
+
+    def prepare_cloth(self, cloth):
+        """Places the cloth image in the dataset's cloth folder, generates its mask and returns its file name."""
+        cloth_dir = osp.join(self.data_path, 'cloth')
+        if osp.abspath(osp.dirname(cloth)) == osp.abspath(cloth_dir):
+            c_name = osp.basename(cloth)
+        else:
+            if not osp.exists(cloth):
+                raise ValueError("'{}' is not a valid cloth image path".format(cloth))
+            # Uploads are stored under a content-addressed name: two users uploading different files with the same
+            # name never overwrite each other's cloth (or mask), and identical uploads share one copy.
+            with open(cloth, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:12]
+            c_name = '{}_{}'.format(digest, osp.basename(cloth))
+
+        cloth_path = osp.join(cloth_dir, c_name)
+        mask_path = osp.join(self.data_path, 'cloth-mask', c_name)
+        with self.cloth_lock:
+            if not osp.exists(cloth_path):
+                tmp_path = '{}.{}.tmp'.format(cloth_path, uuid.uuid4().hex)
+                shutil.copyfile(cloth, tmp_path)
+                os.replace(tmp_path, cloth_path)
+            generate_cloth_mask(cloth_path, mask_path)
+        return c_name
+
+    def create_job(self):
+        self.collect_garbage()
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, osp.join(self.opt.save_dir, job_id))
+        with self.jobs_lock:
+            self.jobs[job_id] = job
+        return job
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def cloth_cache(self, preview_scale):
+        with self.cloth_lock:
+            if preview_scale not in self.cloth_caches:
+                self.cloth_caches[preview_scale] = make_cloth_cache(preview_opt(self.opt, preview_scale))
+            return self.cloth_caches[preview_scale]
+
+    def run_batch(self, scale, samples):
+        # BatchScheduler callback: the samples of possibly different requests (and cloths), loaded at 1/scale
+        opt = preview_opt(self.opt, scale)
+        with self.model_lock, torch.no_grad():
+            output, unpaired_names = tryon_batch(opt, self.seg, self.gmm, self.alias, data.default_collate(samples),
+                                                 self.cloth_cache(scale))
+        return [(output[i:i + 1], unpaired_names[i:i + 1]) for i in range(len(samples))]
+
+    def iter_scheduled(self, dataset, scale):
+        # Loads the samples of a request on its thread and submits them to the scheduler one by one; yields
+        # ('full', output, unpaired_names) for every sample, in order, as soon as its batch has run.
+        futures = deque()
+        for index in range(len(dataset)):
+            futures.append(self.scheduler.submit(scale, dataset[index]))
+            while futures and futures[0].done():
+                yield ('full',) + futures.popleft().result()
+        while futures:
+            yield ('full',) + futures.popleft().result()
+
+    def tryon_iter(self, cloth, person_ids=None, job=None, preview_scale=1, progressive=False):
+        """
+        Renders the given cloth on every requested person, yielding each result as soon as it is written.
+
+        Args:
+            cloth (str): Path to the cloth image.
+            person_ids (list): Person image names (e.g. '00891_00.jpg'); defaults to the whole catalogue.
+            job (Job): Job to run the request as; a new one is created if not given.
+            preview_scale (int): Render at 1/preview_scale of the load size (2: 512x384, 4: 256x192).
+            progressive (bool): First render every person at 1/preview_scale (into the job's preview/ directory), then
+                at the full load size, reusing the segmentation of the preview (previews run at most a few batches
+                ahead of the full renders, see iter_tryon_progressive).
+
+        Yields:
+            str: Path of the next generated try-on image (or preview), inside the job's output directory.
+        """
+        if job is None:
+            job = self.create_job()
+        job.status = 'running'
+        start = time.time()
+        try:
+            c_name = self.prepare_cloth(cloth)
+            if person_ids is None:
+                person_ids = self.catalogue
+            if progressive and preview_scale == 1:
+                raise ValueError('progressive rendering needs a preview_scale greater than 1')
+
+            # progressive requests load the data at the full size; previews are downsampled from it
+            load_scale = 1 if progressive else preview_scale
+            opt = preview_opt(self.opt, load_scale)
+            pairs = [(img_name, c_name) for img_name in person_ids]
+            result_keys = {}
+            if self.result_cache is not None:
+                # cached outputs are returned right away (without a preview); only the missing pairs are rendered
+                os.makedirs(job.output_dir, exist_ok=True)
+                missing, result_keys = split_cached(opt, self.result_cache, pairs, job.output_dir)
+                for img_name, c_name in pairs:
+                    if (img_name, c_name) not in missing:
+                        if not job.results:
+                            job.first_image_latency = time.time() - start
+                            self.first_image_latencies.append(job.first_image_latency)
+                        job.results.append(osp.join(job.output_dir, output_name(img_name, c_name)))
+                        yield job.results[-1]
+                pairs = missing
+            cloth_cache = self.cloth_cache(load_scale)
+            dataset = VITONDataset(opt, pairs=pairs, cloth_cache=cloth_cache)
+            if not pairs:
+                batches = []
+            elif progressive:
+                loader = VITONDataLoader(opt, dataset)
+                batches = locked(iter_tryon_progressive(opt, self.seg, self.gmm, self.alias, loader.data_loader,
+                                                        preview_scale, cloth_cache), self.model_lock)
+            elif self.scheduler is not None:
+                batches = self.iter_scheduled(dataset, load_scale)
+            else:
+                loader = VITONDataLoader(opt, dataset)
+                batches = (('full', output, unpaired_names) for output, unpaired_names in
+                           locked(iter_tryon(opt, self.seg, self.gmm, self.alias, loader.data_loader, cloth_cache),
+                                  self.model_lock))
+
+            for stage, output, unpaired_names in batches:
+                if stage == 'preview':
+                    output_dir, paths = osp.join(job.output_dir, PREVIEW_DIR), job.previews
+                else:
+                    output_dir, paths = job.output_dir, job.results
+                os.makedirs(output_dir, exist_ok=True)
+                save_images(output, unpaired_names, output_dir)
+                if stage == 'full' and self.result_cache is not None:
+                    store_results(self.result_cache, result_keys, unpaired_names, output_dir)
+                if not job.results and not job.previews:
+                    job.first_image_latency = time.time() - start
+                    self.first_image_latencies.append(job.first_image_latency)
+                for name in unpaired_names:
+                    paths.append(osp.join(output_dir, name))
+                    yield paths[-1]
+        except GeneratorExit:
+            job.status = 'cancelled'
+            job.finished = time.time()
+            raise
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.finished = time.time()
+            raise
+
+        job.status = 'done'
+        job.finished = time.time()
+        job.latency = job.finished - start
+        self.latencies.append(job.latency)
+        print("job {}: {} images in {:.2f}s ({})".format(job.id, len(job.results), job.latency,
+                                                        'cold' if len(self.latencies) == 1 else 'warm'))
+
+    def tryon(self, cloth, person_ids=None, preview_scale=1, progressive=False):
+        """Same as `tryon_iter`, but waits for the whole request and returns the list of result paths."""
+        return list(self.tryon_iter(cloth, person_ids, preview_scale=preview_scale, progressive=progressive))
+
+    def submit(self, cloth, person_ids=None, preview_scale=1, progressive=False):
+        """Queues a request and returns its Job immediately; poll `get_job(job.id)` for its status."""
+        job = self.create_job()
+
+        def run():
+            try:
+                for _ in self.tryon_iter(cloth, person_ids, job, preview_scale, progressive):
+                    pass
+            except Exception:
+                pass  # recorded in job.status / job.error
+
+        self.executor.submit(run)
+        return job
+
+    def collect_garbage(self):
+        """Deletes finished jobs (and their outputs) that are too old, then the oldest ones while over budget."""
+        now = time.time()
+        with self.jobs_lock:
+            finished = [job for job in self.jobs.values() if job.finished is not None]
+        expired = [job for job in finished if now - job.finished > self.job_ttl]
+        remaining = [job for job in finished if job not in expired]
+
+        sizes = {job.id: directory_size(job.output_dir) for job in remaining}
+        total = sum(sizes.values())
+        for job in sorted(remaining, key=lambda job: job.finished):
+            if total <= self.max_results_bytes:
+                break
+            expired.append(job)
+            total -= sizes[job.id]
+
+        for job in expired:
+            shutil.rmtree(job.output_dir, ignore_errors=True)
+            with self.jobs_lock:
+                self.jobs.pop(job.id, None)
+
+    def stats(self):
+        """
+        Cold start (network construction + checkpoint loading), request latencies in seconds, job counts and the
+        metrics of the batch scheduler and the result cache.
+        """
+        warm = self.latencies[1:]
+        warm_first_image = self.first_image_latencies[1:]
+        with self.jobs_lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            'cold_start': self.cold_start,
+            'requests': len(self.latencies),
+            'first_request': self.latencies[0] if self.latencies else None,
+            'warm_mean': sum(warm) / len(warm) if warm else None,
+            'warm_min': min(warm) if warm else None,
+            'warm_max': max(warm) if warm else None,
+            'warm_first_image_mean': sum(warm_first_image) / len(warm_first_image) if warm_first_image else None,
+            'jobs': {status: statuses.count(status) for status in set(statuses)},
+            'scheduler': self.scheduler.stats() if self.scheduler is not None else None,
+            'result_cache': self.result_cache.stats() if self.result_cache is not None else None,
+        }
+
+
+def locked(iterable, lock):
+    # Yields the items of `iterable`, holding `lock` while each one is produced (and while the iterable is closed),
+    # but not while the caller processes it.
+    iterator = iter(iterable)
+    try:
+        while True:
+            with lock:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            with lock:
+                iterator.close()
+
+
+def is_preview(result):
+    return osp.basename(osp.dirname(result)) == PREVIEW_DIR
+
+
+def directory_size(directory):
+    if not osp.isdir(directory):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+class TryOnRequestHandler(BaseHTTPRequestHandler):
+    """
+    Local HTTP endpoint in front of a TryOnService.
+
+    POST /tryon  {"cloth": "<path>", "person_ids": [...]}  ->  {"results": [...], "seconds": ...}
+    POST /tryon  {..., "preview_scale": 2}                  ->  same, rendered at 512x384
+    POST /tryon  {..., "preview_scale": 4, "progressive": true, "stream": true}
+                                                            ->  a {"result": ..., "preview": true} line per person at
+                                                                256x192 first, then one per full-size image
+    POST /tryon  {..., "stream": true}                      ->  one {"result": "<path>", "seconds": ...} line per image
+    POST /jobs   {"cloth": "<path>", "person_ids": [...]}  ->  Job.to_dict(), without waiting for the job
+    GET  /jobs                                              ->  [Job.to_dict(), ...]
+    GET  /jobs/<id>                                         ->  Job.to_dict()
+    GET  /stats                                             ->  TryOnService.stats()
+
+    Failures are answered with {"error": ...}: a 400 for invalid requests, a 500 otherwise, and a last line of a
+    streamed response.
+    """
+    service = None
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.service.stats())
+        elif self.path == '/jobs':
+            with self.service.jobs_lock:
+                jobs = list(self.service.jobs.values())
+            self.send_json(200, [job.to_dict() for job in jobs])
+        elif self.path.startswith('/jobs/'):
+            job = self.service.get_job(self.path[len('/jobs/'):])
+            if job is None:
+                self.send_json(404, {'error': 'unknown job {}'.format(self.path[len('/jobs/'):])})
+            else:
+                self.send_json(200, job.to_dict())
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def send_error_json(self, error):
+        # bad requests (a missing field, invalid JSON, an unknown cloth or person image) are answered with a 400, any
+        # other failure with a 500
+        status = 400 if isinstance(error, (KeyError, ValueError, FileNotFoundError)) else 500
+        self.send_json(status, {'error': str(error)})
+
+    def do_POST(self):
+        if self.path == '/jobs':
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not osp.exists(request['cloth']):
+                    raise ValueError("'{}' is not a valid cloth image path".format(request['cloth']))
+                job = self.service.submit(request['cloth'], request.get('person_ids'),
+                                          request.get('preview_scale', 1), request.get('progressive', False))
+            except Exception as e:
+                self.send_error_json(e)
+                return
+            self.send_json(202, job.to_dict())
+            return
+        if self.path != '/tryon':
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            start = time.time()
+            results = self.service.tryon_iter(request['cloth'], request.get('person_ids'),
+                                              preview_scale=request.get('preview_scale', 1),
+                                              progressive=request.get('progressive', False))
+            # run up to the first image here, so that invalid requests are still answered with a 400
+            results = itertools.chain([next(results)], results)
+        except StopIteration:
+            results = iter([])
+        except Exception as e:
+            self.send_error_json(e)
+            return
+
+        if not request.get('stream'):
+            try:
+                results = list(results)
+            except Exception as e:
+                self.send_error_json(e)
+                return
+            self.send_json(200, {'results': [result for result in results if not is_preview(result)],
+                                 'previews': [result for result in results if is_preview(result)],
+                                 'seconds': time.time() - start})
+            return
+
+        # newline-delimited JSON, one line per image as soon as it is written; the response ends when the
+        # connection is closed (HTTP/1.0). A failure after the first image ends it with an {"error": ...} line.
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for result in results:
+                self.write_line({'result': result, 'preview': is_preview(result), 'seconds': time.time() - start})
+        except Exception as e:
+            self.write_line({'error': str(e), 'seconds': time.time() - start})
+
+    def write_line(self, payload):
+        self.wfile.write(json.dumps(payload).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--job_ttl', type=int, default=3600, help='seconds a finished job and its images are kept')
+    parser.add_argument('--max_results_mb', type=int, default=1024,
+                        help='oldest finished jobs are deleted while their images take more than this')
+    parser.add_argument('--max_concurrent_jobs', type=int, default=2)
+    parser.add_argument('--max_batch_size', type=int, default=4,
+                        help='# of pairs from concurrent requests batched together (0 disables the batch scheduler)')
+    parser.add_argument('--max_batch_wait_ms', type=float, default=20,
+                        help='longest a pair waits for its batch to fill up')
+    opt = parser.parse_args()
+    print(opt)
+
+    TryOnRequestHandler.service = TryOnService(opt, job_ttl=opt.job_ttl, max_results_mb=opt.max_results_mb,
+                                               max_concurrent_jobs=opt.max_concurrent_jobs,
+                                               max_batch_size=opt.max_batch_size,
+                                               max_batch_wait=opt.max_batch_wait_ms / 1000)
+    print("cold start: {:.2f}s".format(TryOnRequestHandler.service.cold_start))
+
+    server = ThreadingHTTPServer((opt.host, opt.port), TryOnRequestHandler)
+    print("serving try-on requests on http://{}:{}".format(opt.host, opt.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
 import streamlit as st
 import os
-import subprocess
-import time
 import logging
-import cv2
+
+from service import TryOnService
+from test import get_opt
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -11,7 +11,7 @@ logging.basicConfig(level=logging.DEBUG)
 # Set paths
 UPLOAD_FOLDER = "cloth/"
 RESULTS_FOLDER = "results/"
-AUTOMATED_SCRIPT = "automated.py"  # Calls automated.py with cloth_path
+RESULT_CACHE_FOLDER = "result-cache/"  # re-uploads of the same cloth reuse these images
 
 # Ensure required folders exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -20,6 +20,14 @@ os.makedirs(RESULTS_FOLDER, exist_ok=True)
 # Streamlit UI
 st.set_page_config(page_title="Virtual Try-On System", layout="wide")
 
+
+@st.cache_resource
+def get_service():
+    """Loads the networks once per server process; every later click reuses the warm models."""
+    return TryOnService(get_opt(["--name", "virtual_tryon", "--save_dir", RESULTS_FOLDER, "--person_cache",
+                                 "--result_cache_dir", RESULT_CACHE_FOLDER]))
+
+
 st.title("👕 Virtual Try-On System")
 st.write("Upload a clothing image and see it applied on all models!")
 
@@ -34,48 +42,56 @@ if uploaded_file is not None:
 
     st.success(f"✅ Image saved: {uploaded_file.name}")
 
+# Previews render at 512x384 (or 256x192), several times faster than the full 1024x768 images
+render_mode = st.radio("Render mode", ["Full (1024x768)", "⚡ Fast preview (512x384)",
+                                       "🔄 Preview first (256x192), then full"])
+
 # Button to run the virtual try-on process
 if st.button("Run Virtual Try-On"):
     if uploaded_file is None:
         st.error("⚠️ Please upload a clothing image first!")
     else:
-        st.info("⏳ Running the virtual try-on process (automated.py)... Please wait.")
-
-        # Run automated.py with cloth image path as argument
-        # Run automated.py with cloth image path
-        auto_result = subprocess.run(["python", AUTOMATED_SCRIPT, file_path], capture_output=True, text=True)
-            
-            # Print full output for debugging
-        st.text("🔍 Debugging automated.py Output:")
-        st.text(auto_result.stdout)
-        if auto_result.stderr:
-                st.error("❌ automated.py Error:")
-                st.text(auto_result.stderr)
-                st.stop()
-
-        # Wait for results to be generated
-        time.sleep(5)
-
-        # Check if images exist in results folder
-        if os.path.exists(RESULTS_FOLDER) and os.listdir(RESULTS_FOLDER):
-            st.success("🎉 Virtual try-on completed! Here are the results:")
-            
-            # Display images
-            for image_file in os.listdir(RESULTS_FOLDER):
-                image_path = os.path.join(RESULTS_FOLDER, image_file)
-                st.image(image_path, caption=image_file, use_container_width=True)
+        service = get_service()
+        st.info("⏳ Running the virtual try-on process... Please wait.")
+
+        # Display each image as soon as it is generated (this click's job has its own output folder, so
+        # concurrent users never see each other's results)
+        gallery = st.container()
+        slots = {}
+        results = []
+        if render_mode.startswith("🔄"):
+            tryon_kwargs = {"preview_scale": 4, "progressive": True}
+        else:
+            tryon_kwargs = {"preview_scale": 2 if render_mode.startswith("⚡") else 1}
+        job = service.create_job()
+        try:
+            for image_path in service.tryon_iter(file_path, job=job, **tryon_kwargs):
+                # a full-size image replaces the preview of the same person
+                name = os.path.basename(image_path)
+                if name not in slots:
+                    slots[name] = gallery.empty()
+                slots[name].image(image_path, caption=name, use_container_width=True)
+                results.append(image_path)
+        except Exception as e:
+            st.error(f"❌ Virtual try-on failed: {e}")
+            st.stop()
+
+        if results:
+            st.success("🎉 Virtual try-on completed!")
+            st.caption(f"⏱️ Model load (cold start): {service.cold_start:.2f}s | "
+                       f"First image: {job.first_image_latency:.2f}s | "
+                       f"All images: {job.latency:.2f}s")
         else:
             st.warning("⚠️ No output images found. Please check if the try-on process completed successfully.")
 
-# Button to check files in results folder
+# Button to check the try-on jobs (each run writes into its own results/<job id>/ folder)
 if st.button("Check Results Folder"):
-    if os.path.exists(RESULTS_FOLDER):
-        files = os.listdir(RESULTS_FOLDER)
-        if files:
-            st.write("✅ Found the following output images:")
-            for file in files:
-                st.write(file)
-        else:
-            st.write("⚠️ No images found in results/.")
+    service = get_service()
+    with service.jobs_lock:
+        jobs = list(service.jobs.values())
+    if jobs:
+        st.write("✅ Found the following try-on jobs:")
+        for job in jobs:
+            st.write(f"{job.id}: {job.status}, {len(job.results)} image(s) in {job.output_dir}")
     else:
-        st.write("⚠️ results/ folder does not exist.")
+        st.write("⚠️ No try-on jobs yet.")
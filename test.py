@@ -1,25 +1,99 @@
 import argparse
+import copy
 import os
+import time
+import warnings
+from collections import OrderedDict, deque
 
 import torch
 from torch import nn
 from torch.nn import functional as F
-import torchgeometry as tgm
 
-from datasets import VITONDataset, VITONDataLoader
-from networks import SegGenerator, GMM, ALIASGenerator
-from utils import gen_noise, load_checkpoint, save_images
-
-
-def get_opt():
+from backends import BACKENDS, load_exported_networks
+from cache import ClothCache, ResultCache
+from datasets import VITONDataset, VITONDataLoader, read_pairs
+from networks import SegGenerator, GMM, ALIASGenerator, ALIASNorm
+from pipeline import print_pipeline_stats, run_pipeline
+from profiler import PROFILER, instrument_networks
+from utils import available_memory, blur, gen_noise, load_checkpoint, make_label_lut, remap_one_hot, save_images
+
+# 13 predicted segmentation classes -> 7 classes used by the GMM and ALIASGenerator
+PARSE_LABELS = {
+    0:  ['background',  [0]],
+    1:  ['paste',       [2, 4, 7, 8, 9, 10, 11]],
+    2:  ['upper',       [3]],
+    3:  ['hair',        [1]],
+    4:  ['left_arm',    [5]],
+    5:  ['right_arm',   [6]],
+    6:  ['noise',       [12]]
+}
+PARSE_LUT = make_label_lut(PARSE_LABELS, 13)
+
+# Width the networks were trained at; the 15x15, sigma 3 Gaussian blur of the segmentation is scaled relative to it.
+FULL_WIDTH = 768
+
+# --precision names -> autocast dtypes (None: autocast disabled)
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+STAGES = ('seg', 'gmm', 'alias')
+
+# Rough peak memory of one sample through Seg, GMM and ALIAS, per output pixel (~3 GB at 1024x768).
+BYTES_PER_PIXEL = 4096
+
+
+def precision_spec(spec):
+    # 'stage=precision' -> (stage, precision); 'all' stands for every stage
+    stage, _, precision = spec.partition('=')
+    if stage not in STAGES + ('all',) or precision not in PRECISIONS:
+        raise argparse.ArgumentTypeError("'{}' is not of the form {{{}}}={{{}}}".format(
+            spec, ','.join(STAGES + ('all',)), ','.join(PRECISIONS)))
+    return stage, precision
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--name', type=str, required=True)
 
-    parser.add_argument('-b', '--batch_size', type=int, default=1)
+    parser.add_argument('-b', '--batch_size', type=int, default=1,
+                        help='with --fanout, 0 picks the largest batch that fits in the available RAM')
     parser.add_argument('-j', '--workers', type=int, default=1)
     parser.add_argument('--load_height', type=int, default=1024)
     parser.add_argument('--load_width', type=int, default=768)
+    parser.add_argument('--preview_scale', type=int, default=1,
+                        help='load and render at 1/scale of the load size (2: 512x384, 4: 256x192) for cheap previews; '
+                             'uses the same checkpoints')
+    parser.add_argument('--fast_parse', action='store_true',
+                        help='blur and argmax the segmentation at 256x192 and upsample the labels, instead of blurring '
+                             'the upsampled logits at the output size')
+    parser.add_argument('--blur_mode', choices=['gaussian', 'box'], default='gaussian',
+                        help='smoothing of the segmentation before the argmax: separable Gaussian, or three box filters '
+                             'approximating it')
     parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--fanout', action='store_true',
+                        help='load each cloth once and broadcast it against stacked batches of persons')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='overlap data loading, the networks and image saving in separate stages (threads)')
+    parser.add_argument('--load_queue_depth', type=int, default=2,
+                        help='with --pipeline, # of loaded batches waiting for the networks')
+    parser.add_argument('--save_queue_depth', type=int, default=2,
+                        help='with --pipeline, # of output batches waiting to be saved')
+    parser.add_argument('--person_cache', action='store_true',
+                        help='read the cloth-independent person tensors from <dataset_dir>/<dataset_mode>/person-cache/ '
+                             '(built on first use, see cache.py)')
+    parser.add_argument('--agnostic_impl', choices=['cv2', 'pil'], default='cv2',
+                        help='rasterize the agnostic masks with OpenCV into a single buffer (differing from PIL only '
+                             'along the edges of the drawn shapes, see tests/test_agnostic.py), or with the original '
+                             'PIL drawing code')
+
+    parser.add_argument('--cloth_cache_size', type=int, default=8,
+                        help='# of cloths whose resized tensors and GMM features are kept in memory (0 disables)')
+    parser.add_argument('--cloth_cache_dir', type=str, default='',
+                        help='if set, cloths evicted from the in-memory cache are spilled to this directory')
+
+    parser.add_argument('--result_cache_dir', type=str, default='',
+                        help='if set, reuse the output images of (cloth, person) pairs already rendered with the same '
+                             'checkpoints and options, from this content-addressed cache')
+    parser.add_argument('--result_cache_mb', type=int, default=1024,
+                        help='least recently used results are evicted while the cache takes more than this')
 
     parser.add_argument('--dataset_dir', type=str, default='./datasets/')
     parser.add_argument('--dataset_mode', type=str, default='test')
@@ -28,10 +102,29 @@ def get_opt():
     parser.add_argument('--save_dir', type=str, default='./results/')
 
     parser.add_argument('--display_freq', type=int, default=1)
+    parser.add_argument('--profile', action='store_true',
+                        help='record the wall/CPU time and peak RSS of every pipeline stage, print a summary and save '
+                             'profile.jsonl and profile_trace.json (Chrome trace) to save_dir; implies --workers 0')
 
     parser.add_argument('--seg_checkpoint', type=str, default='seg_final.pth')
     parser.add_argument('--gmm_checkpoint', type=str, default='gmm_final.pth')
     parser.add_argument('--alias_checkpoint', type=str, default='alias_final.pth')
+    parser.add_argument('--freeze', action='store_true',
+                        help='bake spectral_norm and fold BatchNorm into the convolutions for inference; the frozen '
+                             'checkpoints written by freeze.py (<name>_frozen.pth) are loaded when up to date')
+    parser.add_argument('--precision', type=precision_spec, nargs='*', default=[],
+                        help='CPU autocast precision of each stage, e.g. seg=bf16 gmm=bf16 (ALIAS stays fp32) or '
+                             'all=bf16; later specs override earlier ones. The numerically sensitive ops (TPS grid, '
+                             'mask normalization, output layer) always run in fp32; see precision.py for the quality')
+    parser.add_argument('--backend', choices=BACKENDS, default='eager',
+                        help='run the networks as eager PyTorch modules, or as the graphs exported by export.py to '
+                             '--export_dir (TorchScript, or ONNX run by ONNX Runtime); the graphs are fixed to the '
+                             'load size they were exported at')
+    parser.add_argument('--export_dir', type=str, default='./checkpoints/export/')
+    parser.add_argument('--quantize', action='store_true',
+                        help='run the int8 networks calibrated and saved by quantize.py (<name>_int8.pth): the '
+                             'convolutions of SegGenerator, the GMM feature extractors and ALIASGenerator; implies '
+                             '--freeze')
 
     # common
     parser.add_argument('--semantic_nc', type=int, default=13, help='# of human-parsing map classes')
@@ -40,6 +133,8 @@ def get_opt():
 
     # for GMM
     parser.add_argument('--grid_size', type=int, default=5)
+    parser.add_argument('--warp_grid_factor', type=int, default=1,
+                        help='evaluate the TPS warp grid at 1/factor of the load size and bilinearly upsample it')
 
     # for ALIASGenerator
     parser.add_argument('--norm_G', type=str, default='spectralaliasinstance')
@@ -47,116 +142,487 @@ def get_opt():
     parser.add_argument('--num_upsampling_layers', choices=['normal', 'more', 'most'], default='most',
                         help='If \'more\', add upsampling layer between the two middle resnet blocks. '
                              'If \'most\', also add one more (upsampling + resnet) layer at the end of the generator.')
+    return parser
+
+
+def get_opt(args=None):
+    opt = get_parser().parse_args(args)
+    return opt
 
-    opt = parser.parse_args()
+
+def preview_opt(opt, scale):
+    """Copy of opt whose load (and output) size is 1/scale of its own."""
+    if scale == 1:
+        return opt
+    opt = copy.copy(opt)
+    opt.load_height //= scale
+    opt.load_width //= scale
     return opt
 
 
-def test(opt, seg, gmm, alias):
-    up = nn.Upsample(size=(opt.load_height, opt.load_width), mode='bilinear')
-    gauss = tgm.image.GaussianBlur((15, 15), (3, 3))
-    
-    # Since we're not using CUDA, no need to move this to the GPU
-    # gauss.cuda()  # Removed because it's not needed in a CPU-only environment.
+def stage_precision(opt, stage):
+    precision = 'fp32'
+    for spec_stage, spec_precision in opt.precision:
+        if spec_stage in (stage, 'all'):
+            precision = spec_precision
+    return precision
+
+
+def autocast(opt, stage):
+    # CPU autocast of a stage's networks at its --precision (disabled in fp32)
+    dtype = PRECISIONS[stage_precision(opt, stage)]
+    return torch.autocast('cpu', dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
+
+def make_cloth_cache(opt):
+    if opt.cloth_cache_size <= 0:
+        return None
+    return ClothCache(os.path.join(opt.dataset_dir, opt.dataset_mode), opt.load_height, opt.load_width,
+                      max_entries=opt.cloth_cache_size, spill_dir=opt.cloth_cache_dir or None)
+
+
+def make_result_cache(opt):
+    if not opt.result_cache_dir:
+        return None
+    return ResultCache(opt.result_cache_dir, opt.result_cache_mb)
+
+
+def split_cached(opt, result_cache, pairs, output_dir):
+    # Copies the cached outputs of `pairs` to output_dir; returns the pairs still to render and the cache key of each
+    # of their output names, to store the new outputs with (see store_results).
+    missing = []
+    keys = {}
+    for img_name, c_name in pairs:
+        key = result_cache.key(opt, img_name, c_name)
+        if not result_cache.get(key, os.path.join(output_dir, output_name(img_name, c_name))):
+            missing.append((img_name, c_name))
+            keys[output_name(img_name, c_name)] = key
+    return missing, keys
+
+
+def store_results(result_cache, keys, unpaired_names, output_dir):
+    # outputs that were not written (e.g. a run interrupted before reaching them) are skipped
+    for name in unpaired_names:
+        if name in keys and os.path.exists(os.path.join(output_dir, name)):
+            result_cache.put(keys[name], os.path.join(output_dir, name))
+
+
+def cloth_features(gmm, cloth_cache, c_names, c_gmm):
+    # extractionB runs once per distinct cloth; a cloth shared by the whole batch is broadcast inside the GMM
+    features = {}
+    for j, c_name in enumerate(c_names):
+        if c_name not in features:
+            c_single = c_gmm[j:j + 1] if c_gmm.size(0) > 1 else c_gmm
+            # stored in fp32 whatever the precision of the GMM, as they outlive the batch
+            features[c_name] = cloth_cache.get_feature(c_name, lambda: gmm.encode_cloth(c_single).float())
+    if len(features) == 1:
+        return features[c_names[0]]
+    return torch.cat([features[c_name] for c_name in c_names])
+
+
+def downsample_inputs(inputs):
+    """
+    The 256x192 level of a batch, read by SegGenerator (bilinear) and the GMM (nearest), as they were trained. It is
+    built once per batch and, in progressive rendering, shared by both phases.
+    """
+    c = inputs['cloth']['unpaired']  # No .cuda() needed for CPU
+    cm = inputs['cloth_mask']['unpaired']  # No .cuda() needed for CPU
+    # The cloth tensors may hold a single cloth shared by every person of the batch (see test_fanout), in which case
+    # they are only resampled once.
+    return {
+        'parse_agnostic': F.interpolate(inputs['parse_agnostic'], size=(256, 192), mode='bilinear'),
+        'pose': F.interpolate(inputs['pose'], size=(256, 192), mode='bilinear'),
+        'c_masked': F.interpolate(c * cm, size=(256, 192), mode='bilinear'),
+        'cm': F.interpolate(cm, size=(256, 192), mode='bilinear'),
+        'img_agnostic_nearest': F.interpolate(inputs['img_agnostic'], size=(256, 192), mode='nearest'),
+        'pose_nearest': F.interpolate(inputs['pose'], size=(256, 192), mode='nearest'),
+        'c_nearest': F.interpolate(c, size=(256, 192), mode='nearest'),
+    }
+
+
+def segment(seg, low):
+    # Part 1. Segmentation generation, at 256x192 whatever the load size (the probabilities in fp32, whatever the
+    # precision of the network)
+    b = low['parse_agnostic'].size(0)
+    cm_down = low['cm'].expand(b, -1, -1, -1)
+    c_masked_down = low['c_masked'].expand(b, -1, -1, -1)
+    seg_input = torch.cat((cm_down, c_masked_down, low['parse_agnostic'], low['pose'], gen_noise(cm_down.size())),
+                          dim=1)
+    return seg(seg_input).float()
+
+
+def blur_segmentation(x, mode='gaussian'):
+    blur_scale = x.size(3) / FULL_WIDTH
+    return blur(x, 2 * round(7 * blur_scale) + 1, 3 * blur_scale, mode)
+
+
+def parse_at(parse_pred_down, size, fast=False, blur_mode='gaussian'):
+    # Turns the segmentation logits into the 7-class one-hot parse map at `size`. The 15x15, sigma 3 blur was tuned at
+    # 1024x768 and is scaled with the width. By default the logits are upsampled, blurred and argmaxed at `size`; with
+    # `fast`, blur and argmax run at 256x192 and the labels are upsampled (nearest), which costs a fraction of it but
+    # gives blockier region boundaries.
+    with PROFILER.stage('blur_argmax'):
+        if fast:
+            parse_pred = blur_segmentation(parse_pred_down, blur_mode).argmax(dim=1)[:, None]
+            parse_pred = F.interpolate(parse_pred.float(), size=size, mode='nearest').long()
+        else:
+            up = nn.Upsample(size=size, mode='bilinear')
+            parse_pred = blur_segmentation(up(parse_pred_down), blur_mode).argmax(dim=1)[:, None]
+        return remap_one_hot(parse_pred, PARSE_LUT, 7, dim=1)
+
+
+def warp(gmm, inputs, low, parse, cloth_cache=None):
+    # Part 2. Clothes Deformation: the TPS parameters, from 256x192 inputs (`parse` may be at any size)
+    c_names = inputs['c_name']['unpaired']
+    parse_cloth_gmm = F.interpolate(parse[:, 2:3], size=(256, 192), mode='nearest')
+    gmm_input = torch.cat((parse_cloth_gmm, low['pose_nearest'], low['img_agnostic_nearest']), dim=1)
+
+    with PROFILER.stage('gmm'):
+        if cloth_cache is None:
+            return gmm.compute_theta(gmm_input, low['c_nearest']).float()
+        return gmm.compute_theta(gmm_input,
+                                 featureB=cloth_features(gmm, cloth_cache, c_names, low['c_nearest'])).float()
+
+
+def synthesize(gmm, alias, inputs, parse, theta):
+    # Warps the cloth with the TPS parameters and runs ALIASGenerator, at the size of `inputs` (and `parse`).
+    img_agnostic = inputs['img_agnostic']
+    pose = inputs['pose']
+    c = inputs['cloth']['unpaired']
+    cm = inputs['cloth_mask']['unpaired']
+    b = img_agnostic.size(0)
+
+    warped_grid = gmm.gridGen(theta, img_agnostic.size()[2:])
+    with PROFILER.stage('grid_sample'):
+        warped_c = F.grid_sample(c.expand(b, -1, -1, -1), warped_grid, padding_mode='border')
+        warped_cm = F.grid_sample(cm.expand(b, -1, -1, -1), warped_grid, padding_mode='border')
+
+    # Part 3. Try-on synthesis
+    misalign_mask = parse[:, 2:3] - warped_cm
+    misalign_mask[misalign_mask < 0.0] = 0.0
+    parse_div = torch.cat((parse, misalign_mask), dim=1)
+    parse_div[:, 2:3] -= misalign_mask
+
+    return alias(torch.cat((img_agnostic, pose, warped_c), dim=1), parse, parse_div, misalign_mask).float()
+
+
+def output_name(img_name, c_name):
+    return '{}_{}'.format(img_name.split('_')[0], c_name)
+
+
+def output_names(inputs):
+    unpaired_names = []
+    for img_name, c_name in zip(inputs['img_name'], inputs['c_name']['unpaired']):
+        unpaired_names.append(output_name(img_name, c_name))
+    return unpaired_names
+
+
+def resize_inputs(inputs, size):
+    """The person and cloth tensors of `inputs` resampled to `size`, as if they had been loaded at that size."""
+    def resize(x):
+        return F.interpolate(x, size=size, mode='bilinear', antialias=True)
+
+    resized = dict(inputs)
+    resized['img_agnostic'] = resize(inputs['img_agnostic'])
+    resized['pose'] = resize(inputs['pose'])
+    resized['cloth'] = {'unpaired': resize(inputs['cloth']['unpaired'])}
+    resized['cloth_mask'] = {'unpaired': F.interpolate(inputs['cloth_mask']['unpaired'], size=size, mode='nearest')}
+    return resized
+
+
+def tryon_batch(opt, seg, gmm, alias, inputs, cloth_cache=None):
+    # The output size follows the inputs, so the same networks render previews at a lower load size. Each stage runs
+    # under autocast at its --precision, and returns fp32.
+    low = downsample_inputs(inputs)
+    with autocast(opt, 'seg'):
+        parse_pred_down = segment(seg, low)
+    parse = parse_at(parse_pred_down, inputs['img_agnostic'].size()[2:], opt.fast_parse, opt.blur_mode)
+    with autocast(opt, 'gmm'):
+        theta = warp(gmm, inputs, low, parse, cloth_cache)
+    with autocast(opt, 'alias'):
+        output = synthesize(gmm, alias, inputs, parse, theta)
+    return output, output_names(inputs)
+
+
+@torch.no_grad()
+def iter_tryon(opt, seg, gmm, alias, data_loader, cloth_cache=None):
+    # Yields (output, unpaired_names) as soon as each batch is synthesized, so callers can deliver results
+    # incrementally instead of waiting for the whole list.
+    for inputs in data_loader:
+        with PROFILER.stage('tryon_batch'):
+            result = tryon_batch(opt, seg, gmm, alias, inputs, cloth_cache)
+        yield result
+
+
+@torch.no_grad()
+def iter_tryon_progressive(opt, seg, gmm, alias, data_loader, preview_scale, cloth_cache=None, max_pending=8):
+    """
+    Renders every batch twice: yields ('preview', output, unpaired_names) rendered at 1/preview_scale of the load size,
+    then, later, ('full', output, unpaired_names) at the load size.
+
+    Previews run ahead of the full renders, but the loaded batches wait for their full render in memory (the
+    full-size person and cloth tensors, their 256x192 level and the segmentation logits), so at most `max_pending`
+    batches do: once more are waiting, the oldest one is rendered at full size before the next preview. With a
+    catalogue of at most `max_pending` batches, every preview comes first.
+
+    Seg runs once per batch, in the preview phase; the full phase reuses its 256x192 logits. The full-size
+    blur/argmax and the GMM warp are deliberately computed again: the GMM reads the parse map, and the one of the
+    preview is blurred and argmaxed at the preview size, so reusing the preview's TPS parameters renders a different
+    image than tryon_batch does from the same logits. The service stores the full output in the result cache under
+    the ordinary full-size key, which is only valid if it is exactly that image.
+    """
+    pending = deque()
+
+    def render_full(inputs, low, parse_pred_down):
+        with PROFILER.stage('full_batch'):
+            parse = parse_at(parse_pred_down, inputs['img_agnostic'].size()[2:], opt.fast_parse, opt.blur_mode)
+            with autocast(opt, 'gmm'):
+                theta = warp(gmm, inputs, low, parse, cloth_cache)
+            with autocast(opt, 'alias'):
+                output = synthesize(gmm, alias, inputs, parse, theta)
+        return 'full', output, output_names(inputs)
+
+    for inputs in data_loader:
+        height, width = inputs['img_agnostic'].size()[2:]
+        preview_size = (height // preview_scale, width // preview_scale)
+        with PROFILER.stage('preview_batch'):
+            low = downsample_inputs(inputs)
+            with autocast(opt, 'seg'):
+                parse_pred_down = segment(seg, low)
+            preview_inputs = resize_inputs(inputs, preview_size)
+            preview_parse = parse_at(parse_pred_down, preview_size, opt.fast_parse, opt.blur_mode)
+            with autocast(opt, 'gmm'):
+                theta = warp(gmm, inputs, low, preview_parse, cloth_cache)
+            with autocast(opt, 'alias'):
+                output = synthesize(gmm, alias, preview_inputs, preview_parse, theta)
+        yield 'preview', output, output_names(inputs)
+        pending.append((inputs, low, parse_pred_down))
+        if len(pending) > max_pending:
+            yield render_full(*pending.popleft())
+
+    while pending:
+        yield render_full(*pending.popleft())
+
+
+def test(opt, seg, gmm, alias, pairs=None):
+    # Since we're not using CUDA, nothing has to be moved to the GPU.
+    cloth_cache = make_cloth_cache(opt)
+    test_dataset = VITONDataset(opt, pairs=pairs, cloth_cache=cloth_cache)
+    test_loader = VITONDataLoader(opt, test_dataset)
+
+    num_images = 0
+    start = time.time()
+    for i, (output, unpaired_names) in enumerate(iter_tryon(opt, seg, gmm, alias, test_loader.data_loader,
+                                                            cloth_cache)):
+        with PROFILER.stage('save_images'):
+            save_images(output, unpaired_names, opt.save_dir)  # Save directly to results/
+        num_images += len(unpaired_names)
+
+        if (i + 1) % opt.display_freq == 0:
+            print("step: {}".format(i + 1))
+    print_throughput(num_images, time.time() - start)
+
 
-    test_dataset = VITONDataset(opt)
+def test_pipelined(opt, seg, gmm, alias, pairs=None):
+    # Same work as test(), as three stages connected by bounded queues: __getitem__ and collation on a loader thread,
+    # the networks on this thread and save_images (JPEG encoding) on a saver thread, so the next batch is loaded and
+    # the previous one saved while the networks run.
+    cloth_cache = make_cloth_cache(opt)
+    test_dataset = VITONDataset(opt, pairs=pairs, cloth_cache=cloth_cache)
     test_loader = VITONDataLoader(opt, test_dataset)
+    num_images = 0
+
+    def process(inputs):
+        with PROFILER.stage('tryon_batch'):
+            return tryon_batch(opt, seg, gmm, alias, inputs, cloth_cache)
+
+    def save(result):
+        nonlocal num_images
+        output, unpaired_names = result
+        with PROFILER.stage('save_images'):
+            save_images(output, unpaired_names, opt.save_dir)
+        num_images += len(unpaired_names)
 
     with torch.no_grad():
-        for i, inputs in enumerate(test_loader.data_loader):
-            img_names = inputs['img_name']
-            c_names = inputs['c_name']['unpaired']
-
-            img_agnostic = inputs['img_agnostic']  # No .cuda() needed for CPU
-            parse_agnostic = inputs['parse_agnostic']  # No .cuda() needed for CPU
-            pose = inputs['pose']  # No .cuda() needed for CPU
-            c = inputs['cloth']['unpaired']  # No .cuda() needed for CPU
-            cm = inputs['cloth_mask']['unpaired']  # No .cuda() needed for CPU
-
-            # Part 1. Segmentation generation
-            parse_agnostic_down = F.interpolate(parse_agnostic, size=(256, 192), mode='bilinear')
-            pose_down = F.interpolate(pose, size=(256, 192), mode='bilinear')
-            c_masked_down = F.interpolate(c * cm, size=(256, 192), mode='bilinear')
-            cm_down = F.interpolate(cm, size=(256, 192), mode='bilinear')
-            seg_input = torch.cat((cm_down, c_masked_down, parse_agnostic_down, pose_down, gen_noise(cm_down.size())), dim=1)
-
-            parse_pred_down = seg(seg_input)
-            parse_pred = gauss(up(parse_pred_down))
-            parse_pred = parse_pred.argmax(dim=1)[:, None]
-
-            parse_old = torch.zeros(parse_pred.size(0), 13, opt.load_height, opt.load_width, dtype=torch.float)
-            parse_old.scatter_(1, parse_pred, 1.0)
-
-            labels = {
-                0:  ['background',  [0]],
-                1:  ['paste',       [2, 4, 7, 8, 9, 10, 11]],
-                2:  ['upper',       [3]],
-                3:  ['hair',        [1]],
-                4:  ['left_arm',    [5]],
-                5:  ['right_arm',   [6]],
-                6:  ['noise',       [12]]
-            }
-            parse = torch.zeros(parse_pred.size(0), 7, opt.load_height, opt.load_width, dtype=torch.float)
-            for j in range(len(labels)):
-                for label in labels[j][1]:
-                    parse[:, j] += parse_old[:, label]
-
-            # Part 2. Clothes Deformation
-            agnostic_gmm = F.interpolate(img_agnostic, size=(256, 192), mode='nearest')
-            parse_cloth_gmm = F.interpolate(parse[:, 2:3], size=(256, 192), mode='nearest')
-            pose_gmm = F.interpolate(pose, size=(256, 192), mode='nearest')
-            c_gmm = F.interpolate(c, size=(256, 192), mode='nearest')
-            gmm_input = torch.cat((parse_cloth_gmm, pose_gmm, agnostic_gmm), dim=1)
-
-            _, warped_grid = gmm(gmm_input, c_gmm)
-            warped_c = F.grid_sample(c, warped_grid, padding_mode='border')
-            warped_cm = F.grid_sample(cm, warped_grid, padding_mode='border')
-
-            # Part 3. Try-on synthesis
-            misalign_mask = parse[:, 2:3] - warped_cm
-            misalign_mask[misalign_mask < 0.0] = 0.0
-            parse_div = torch.cat((parse, misalign_mask), dim=1)
-            parse_div[:, 2:3] -= misalign_mask
-
-            output = alias(torch.cat((img_agnostic, pose, warped_c), dim=1), parse, parse_div, misalign_mask)
-
-            unpaired_names = []
-            for img_name, c_name in zip(img_names, c_names):
-                unpaired_names.append('{}_{}'.format(img_name.split('_')[0], c_name))
+        stats = run_pipeline(test_loader.data_loader, process, save, opt.load_queue_depth, opt.save_queue_depth)
+    print_pipeline_stats(stats)
+    print_throughput(num_images, stats['wall'])
 
-            save_images(output, unpaired_names, opt.save_dir)  # Save directly to results/
 
+def print_throughput(num_images, seconds):
+    print("{} images in {:.2f}s: {:.3f} images/sec".format(num_images, seconds, num_images / max(seconds, 1e-9)))
 
-            if (i + 1) % opt.display_freq == 0:
-                print("step: {}".format(i + 1))
 
+def auto_batch_size(opt, max_batch_size):
+    budget = int(available_memory() * 0.75)
+    batch_size = budget // (BYTES_PER_PIXEL * opt.load_height * opt.load_width)
+    return max(1, min(batch_size, max_batch_size))
 
-def main():
-    opt = get_opt()
-    print(opt)
 
-    if not os.path.exists(opt.save_dir):
-       os.makedirs(opt.save_dir)
+def test_fanout(opt, seg, gmm, alias, pairs=None):
+    # One cloth, many models: the cloth is loaded (and encoded by the GMM) once and broadcast against stacked
+    # batches of persons. Unlike the DataLoader path, the last partial batch is kept.
+    cloth_cache = make_cloth_cache(opt)
+    test_dataset = VITONDataset(opt, pairs=pairs, cloth_cache=cloth_cache)
+
+    groups = OrderedDict()
+    for img_name, c_name in zip(test_dataset.img_names, test_dataset.c_names['unpaired']):
+        groups.setdefault(c_name, []).append(img_name)
 
+    batch_size = opt.batch_size
+    if batch_size <= 0:
+        batch_size = auto_batch_size(opt, max(len(img_names) for img_names in groups.values()))
+    print("fan-out: {} cloth(s), batch size {}".format(len(groups), batch_size))
 
+    num_images = 0
+    step = 0
+    start = time.time()
+    with torch.no_grad():
+        for c_name, img_names in groups.items():
+            with PROFILER.stage('dataset/cloth_io'):
+                c, cm = test_dataset.load_cloth(c_name)
+            for k in range(0, len(img_names), batch_size):
+                batch_names = img_names[k:k + batch_size]
+                with PROFILER.stage('dataset/person'):
+                    persons = [test_dataset.load_person(img_name) for img_name in batch_names]
+                inputs = {
+                    'img_name': batch_names,
+                    'c_name': {'unpaired': [c_name] * len(batch_names)},
+                    'img_agnostic': torch.stack([person['img_agnostic'] for person in persons]),
+                    'parse_agnostic': torch.stack([person['parse_agnostic'] for person in persons]),
+                    'pose': torch.stack([person['pose'] for person in persons]),
+                    'cloth': {'unpaired': c[None]},
+                    'cloth_mask': {'unpaired': cm[None]},
+                }
+                with PROFILER.stage('tryon_batch'):
+                    output, unpaired_names = tryon_batch(opt, seg, gmm, alias, inputs, cloth_cache)
+                with PROFILER.stage('save_images'):
+                    save_images(output, unpaired_names, opt.save_dir)
+                num_images += len(unpaired_names)
+
+                step += 1
+                if step % opt.display_freq == 0:
+                    print("step: {}".format(step))
+    print_throughput(num_images, time.time() - start)
+
+
+def build_networks(opt):
     # No need to use .to(device) as all models will be used on the CPU
     seg = SegGenerator(opt, input_nc=opt.semantic_nc + 8, output_nc=opt.semantic_nc)
     gmm = GMM(opt, inputA_nc=7, inputB_nc=3)
     opt.semantic_nc = 7
     alias = ALIASGenerator(opt, input_nc=9)
     opt.semantic_nc = 13
+    return seg, gmm, alias
 
-    # Load model checkpoints (no .cuda() needed)
-    load_checkpoint(seg, os.path.join(opt.checkpoint_dir, opt.seg_checkpoint))
-    load_checkpoint(gmm, os.path.join(opt.checkpoint_dir, opt.gmm_checkpoint))
-    load_checkpoint(alias, os.path.join(opt.checkpoint_dir, opt.alias_checkpoint))
 
-    # We no longer need to move models to CUDA since we're using the CPU.
+def derived_checkpoint_path(checkpoint_path, suffix):
+    # freeze.py saves the frozen variant of <name>.pth as <name>_frozen.pth, quantize.py the int8 one as <name>_int8.pth
+    root, ext = os.path.splitext(checkpoint_path)
+    return root + suffix + ext
+
+
+def has_derived_checkpoint(checkpoint_path, suffix):
+    # a derived checkpoint older than its source is stale
+    derived_path = derived_checkpoint_path(checkpoint_path, suffix)
+    if not os.path.exists(derived_path):
+        return False
+    return not os.path.exists(checkpoint_path) or os.path.getmtime(derived_path) >= os.path.getmtime(checkpoint_path)
+
+
+def load_networks(opt):
+    if opt.backend != 'eager':
+        if opt.quantize or opt.precision:
+            raise ValueError("--quantize and --precision only apply to the eager backend")
+        return load_exported_networks(opt)
+
+    seg, gmm, alias = build_networks(opt)
+
+    # Load model checkpoints (no .cuda() needed)
+    for net, checkpoint in ((seg, opt.seg_checkpoint), (gmm, opt.gmm_checkpoint), (alias, opt.alias_checkpoint)):
+        checkpoint_path = os.path.join(opt.checkpoint_dir, checkpoint)
+        if opt.quantize:
+            if not has_derived_checkpoint(checkpoint_path, '_int8'):
+                raise ValueError("'{}' is missing or older than '{}': run quantize.py first".format(
+                    derived_checkpoint_path(checkpoint_path, '_int8'), checkpoint_path))
+            # an int8 state dict only fits a network converted the same way; the observers of this conversion never
+            # see data, their (warned about) default parameters are overwritten by the checkpoint
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                net.prepare_int8()
+                net.convert_int8()
+            load_checkpoint(net, derived_checkpoint_path(checkpoint_path, '_int8'))
+        elif opt.freeze and has_derived_checkpoint(checkpoint_path, '_frozen'):
+            # a frozen state dict only fits a frozen network
+            net.freeze_for_inference()
+            load_checkpoint(net, derived_checkpoint_path(checkpoint_path, '_frozen'))
+        else:
+            load_checkpoint(net, checkpoint_path)
+            if opt.freeze:
+                net.freeze_for_inference()
+
+    # merged once here, never on the inference path, which must not write parameters (concurrent requests share them)
+    for module in list(alias.modules()):
+        if isinstance(module, ALIASNorm):
+            module.merge_gamma_beta()
     seg.eval()
     gmm.eval()
     alias.eval()
+    match_memory_format(opt, seg, gmm, alias)
+    return seg, gmm, alias
+
+
+def match_memory_format(opt, seg, gmm, alias):
+    # oneDNN reorders NCHW activations at every reduced-precision convolution (which made bf16 slower than fp32 in
+    # ALIASGenerator), so the convolutions of the stages autocast to bf16/fp16 keep channels-last weights, whose
+    # outputs, and the activations following them, are channels-last too
+    for stage, net in zip(STAGES, (seg, gmm, alias)):
+        memory_format = torch.contiguous_format if stage_precision(opt, stage) == 'fp32' else torch.channels_last
+        for module in net.modules():
+            if isinstance(module, nn.Conv2d):
+                module.to(memory_format=memory_format)
+
+
+def main():
+    opt = get_opt()
+    opt = preview_opt(opt, opt.preview_scale)
+    print(opt)
+
+    if not os.path.exists(opt.save_dir):
+       os.makedirs(opt.save_dir)
 
-    test(opt, seg, gmm, alias)
+    # pairs already rendered with the same inputs, checkpoints and options are copied from the result cache
+    pairs = None
+    result_cache = make_result_cache(opt)
+    if result_cache is not None:
+        all_pairs = read_pairs(os.path.join(opt.dataset_dir, opt.dataset_list))
+        pairs, result_keys = split_cached(opt, result_cache, all_pairs, opt.save_dir)
+        print("result cache: {} of {} pair(s) cached".format(len(all_pairs) - len(pairs), len(all_pairs)))
+        if not pairs:
+            return
+
+    seg, gmm, alias = load_networks(opt)
+    if opt.profile:
+        # DataLoader workers run __getitem__ in other processes, whose stages would be lost
+        opt.workers = 0
+        instrument_networks(PROFILER, seg, gmm, alias)
+        PROFILER.enable()
+
+    if opt.fanout:
+        test_fanout(opt, seg, gmm, alias, pairs)
+    elif opt.pipeline:
+        test_pipelined(opt, seg, gmm, alias, pairs)
+    else:
+        test(opt, seg, gmm, alias, pairs)
+    if result_cache is not None:
+        store_results(result_cache, result_keys, list(result_keys), opt.save_dir)
+        print("result cache: {}".format(result_cache.stats()))
+
+    if opt.profile:
+        PROFILER.disable()
+        PROFILER.print_summary()
+        PROFILER.save_jsonl(os.path.join(opt.save_dir, 'profile.jsonl'))
+        PROFILER.save_chrome_trace(os.path.join(opt.save_dir, 'profile_trace.json'))
 
 
 if __name__ == '__main__':
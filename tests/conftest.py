@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules live at the repository root; put it first so that `test` is this repo's test.py, not the stdlib package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
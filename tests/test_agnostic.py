@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from datasets import VITONDataset
+
+HEIGHT, WIDTH = 1024, 768
+
+# OpenPose BODY_25 keypoints (x, y) of a person at 1024x768; (0, 0) marks a keypoint that was not detected
+POSES = {
+    'left_wrist_missing': [
+        (349.1, 147.8), (400.1, 317.8), (292.4, 329.4), (303.7, 513.4), (0, 0), (513.4, 303.7), (527.6, 547.4),
+        (394.3, 720.3), (351.8, 711.8), (272.6, 697.6), (266.9, 995.1), (0, 0), (428.4, 723.1), (473.8, 1000.8),
+    ] + [(0, 0)] * 11,
+    'arms_raised': [
+        (384.0, 130.0), (384.0, 290.0), (270.5, 300.2), (205.3, 180.7), (190.0, 60.4), (497.6, 298.1),
+        (560.2, 170.9), (575.8, 55.3), (384.0, 640.0), (322.0, 645.5), (318.4, 880.2), (0, 0), (446.3, 642.7),
+        (450.1, 885.6),
+    ] + [(0, 0)] * 11,
+}
+
+# the cv2 masks differ from the PIL ones only along the edges of the drawn shapes (see the [user-007] commit)
+MAX_PARSE_MISMATCH = 2e-4
+MAX_IMG_MISMATCH = 1e-3
+# ... no further than this from them, in pixels
+MAX_EDGE_DISTANCE = 3
+
+
+def make_dataset():
+    dataset = VITONDataset.__new__(VITONDataset)
+    dataset.load_height, dataset.load_width = HEIGHT, WIDTH
+    return dataset
+
+
+def make_parse(seed):
+    # blocks of random labels, so every drawn shape crosses label boundaries
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 20, (HEIGHT // 32, WIDTH // 32), dtype=np.uint8)
+    return Image.fromarray(np.kron(blocks, np.ones((32, 32), dtype=np.uint8)), 'L')
+
+
+def make_img(seed):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8), 'RGB')
+
+
+@pytest.mark.parametrize('pose_name', sorted(POSES))
+def test_parse_agnostic_matches_pil(pose_name):
+    dataset = make_dataset()
+    pose_data = np.array(POSES[pose_name])
+    parse = make_parse(0)
+
+    expected = np.array(dataset.get_parse_agnostic_pil(parse, pose_data.copy()))
+    actual = dataset.get_parse_agnostic(parse, pose_data)
+    assert actual.dtype == np.uint8 and actual.shape == expected.shape
+    assert (actual != expected).mean() <= MAX_PARSE_MISMATCH
+    # the torso and neck labels are removed everywhere, as with PIL
+    assert not np.isin(actual, [5, 6, 7, 10]).any()
+
+
+@pytest.mark.parametrize('pose_name', sorted(POSES))
+def test_img_agnostic_matches_pil(pose_name):
+    dataset = make_dataset()
+    pose_data = np.array(POSES[pose_name])
+    parse = make_parse(1)
+    img = make_img(2)
+
+    expected = np.array(dataset.get_img_agnostic_pil(img, parse, pose_data.copy()))
+    actual = dataset.get_img_agnostic(img, parse, pose_data)
+    assert actual.dtype == np.uint8 and actual.shape == expected.shape
+    assert (actual != expected).any(2).mean() <= MAX_IMG_MISMATCH
+    # the pose is not modified (the PIL implementation rescales the hip keypoints in place)
+    assert np.array_equal(pose_data, np.array(POSES[pose_name]))
+
+
+@pytest.mark.parametrize('pose_name', sorted(POSES))
+def test_img_agnostic_differs_only_along_edges(pose_name):
+    dataset = make_dataset()
+    pose_data = np.array(POSES[pose_name])
+    parse = make_parse(1)
+    img = Image.new('RGB', (WIDTH, HEIGHT))  # black, so the drawn gray mask can be read back
+
+    expected = np.array(dataset.get_img_agnostic_pil(img, parse, pose_data.copy()))
+    actual = dataset.get_img_agnostic(img, parse, pose_data)
+    mask = (expected == 128).all(2).astype(np.uint8)
+    kernel = np.ones((2 * MAX_EDGE_DISTANCE + 1,) * 2, dtype=np.uint8)
+    near_edge = cv2.dilate(mask, kernel) != cv2.erode(mask, kernel)
+    assert not ((actual != expected).any(2) & ~near_edge).any()
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from datasets import PARSE_AGNOSTIC_LABELS
+from test import PARSE_LABELS
+from utils import make_label_lut, remap_one_hot
+
+
+def scatter_then_sum(label_map, labels, num_labels, num_classes):
+    # the code remap_one_hot replaced: one-hot encode every label, then add up the channels of each group
+    size = list(label_map.size())
+    size[1] = num_labels
+    one_hot = torch.zeros(size, dtype=torch.float)
+    one_hot.scatter_(1, label_map, 1.0)
+    size[1] = num_classes
+    remapped = torch.zeros(size, dtype=torch.float)
+    for i in range(len(labels)):
+        for label in labels[i][1]:
+            remapped[:, i] += one_hot[:, label]
+    return remapped
+
+
+@pytest.mark.parametrize('labels, num_labels, num_classes', [
+    (PARSE_AGNOSTIC_LABELS, 20, 13),
+    (PARSE_LABELS, 13, 7),
+])
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_remap_matches_scatter_then_sum(labels, num_labels, num_classes, batch_size):
+    generator = torch.Generator().manual_seed(0)
+    label_map = torch.randint(num_labels, (batch_size, 1, 64, 48), generator=generator)
+    lut = make_label_lut(labels, num_labels)
+
+    expected = scatter_then_sum(label_map, labels, num_labels, num_classes)
+    assert torch.equal(remap_one_hot(label_map, lut, num_classes, dim=1), expected)
+    if batch_size == 1:
+        # VITONDataset.get_person remaps a single (1, H, W) label map along dim 0
+        assert torch.equal(remap_one_hot(label_map[0], lut, num_classes), expected[0])
+
+
+def test_remap_leaves_uncovered_labels_empty():
+    # labels 2 and 5 belong to no group: their pixels are all-zero, as with the channel sums
+    labels = {
+        0: ['a', [0, 3]],
+        1: ['b', [1]],
+        2: ['c', [4]],
+    }
+    generator = torch.Generator().manual_seed(0)
+    label_map = torch.randint(6, (2, 1, 32, 24), generator=generator)
+    lut = make_label_lut(labels, 6)
+    assert lut.tolist() == [0, 1, -1, 0, 2, -1]
+
+    remapped = remap_one_hot(label_map, lut, 3, dim=1)
+    assert torch.equal(remapped, scatter_then_sum(label_map, labels, 6, 3))
+    uncovered = (label_map == 2) | (label_map == 5)
+    assert uncovered.any()
+    assert remapped.sum(dim=1, keepdim=True)[uncovered].eq(0).all()
+    assert remapped.sum(dim=1, keepdim=True)[~uncovered].eq(1).all()
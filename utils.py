@@ -14,6 +14,117 @@ def gen_noise(shape):
     return noise
 
 
+def make_label_lut(labels, num_labels):
+    """
+    Builds a lookup table mapping every label of a label map to the group it belongs to.
+
+    Args:
+        labels (dict): {group index: [group name, [labels of the group]]}.
+        num_labels (int): Number of labels of the input label map.
+
+    Returns:
+        torch.Tensor: Group index of every label (-1 for labels that belong to no group).
+    """
+    lut = torch.full((num_labels,), -1, dtype=torch.long)
+    for group, (_, group_labels) in labels.items():
+        lut[group_labels] = group
+    return lut
+
+
+def remap_one_hot(label_map, lut, num_classes, dim=0):
+    """
+    One-hot encodes the groups of an integer label map in a single scatter.
+
+    Equivalent to one-hot encoding the labels and summing the channels of every group, without materializing the
+    intermediate one-hot map. `label_map` has size 1 along `dim`.
+    """
+    index = lut[label_map]
+    size = list(label_map.size())
+    size[dim] = num_classes
+    one_hot = torch.zeros(size, dtype=torch.float)
+    # labels outside every group stay all-zero, as in the channel-sum formulation
+    one_hot.scatter_(dim, index.clamp(min=0), (index >= 0).float())
+    return one_hot
+
+
+def gaussian_kernel(kernel_size, sigma):
+    # same coefficients as torchgeometry's get_gaussian_kernel
+    x = torch.arange(kernel_size, dtype=torch.float) - kernel_size // 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def box_sizes(sigma, num_boxes=3):
+    # Odd widths of `num_boxes` successive box filters whose combined variance is closest to sigma**2.
+    ideal = np.sqrt(12 * sigma ** 2 / num_boxes + 1)
+    lower = int(ideal) - (1 - int(ideal) % 2)
+    upper = lower + 2
+    num_lower = round((12 * sigma ** 2 - num_boxes * lower ** 2 - 4 * num_boxes * lower - 3 * num_boxes) /
+                      (-4 * lower - 4))
+    return [lower if i < num_lower else upper for i in range(num_boxes)]
+
+
+def blur(x, kernel_size, sigma, mode='gaussian'):
+    """
+    Blurs every channel of a (B, C, H, W) float tensor with zero padding, like torchgeometry's GaussianBlur.
+
+    Each channel is filtered by OpenCV, whose vectorized separable filters are much faster on CPU than a (depthwise)
+    torch convolution.
+
+    Args:
+        x (torch.Tensor): Input tensor.
+        kernel_size (int): Odd size of the Gaussian kernel.
+        sigma (float): Standard deviation of the Gaussian.
+        mode (str): 'gaussian' for the exact kernel applied as two 1D convolutions, or 'box' for three box filters of
+            about the same variance (running sums, independent of the kernel size).
+
+    Returns:
+        torch.Tensor: The blurred tensor.
+    """
+    if mode not in ('gaussian', 'box'):
+        raise ValueError("'{}' is not a recognized blur mode".format(mode))
+    planes = x.detach().float().contiguous().numpy().reshape(-1, x.size(2), x.size(3))
+    output = np.empty_like(planes)
+    kernel = gaussian_kernel(kernel_size, sigma).numpy()
+    for i, plane in enumerate(planes):
+        if mode == 'gaussian':
+            cv2.sepFilter2D(plane, -1, kernel, kernel, dst=output[i], borderType=cv2.BORDER_CONSTANT)
+        else:
+            output[i] = plane
+            for size in box_sizes(sigma):
+                cv2.boxFilter(output[i], -1, (size, size), dst=output[i], borderType=cv2.BORDER_CONSTANT)
+    return torch.from_numpy(output).reshape(x.size())
+
+
+def psnr(x, y, data_range=2.0):
+    """PSNR in dB between two image tensors, over all their pixels (the outputs span [-1, 1], hence `data_range`)."""
+    mse = (x.double() - y.double()).pow(2).mean().item()
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(data_range ** 2 / mse)
+
+
+def ssim(x, y, data_range=2.0):
+    """
+    Mean SSIM (Wang et al. 2004: 11x11 Gaussian window, sigma 1.5, K1 = 0.01, K2 = 0.03) between two (B, C, H, W)
+    image tensors, averaged over the channels.
+    """
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    values = []
+    for a, b in zip(x.detach().double().numpy().reshape(-1, x.size(2), x.size(3)),
+                    y.detach().double().numpy().reshape(-1, y.size(2), y.size(3))):
+        def window(plane):
+            return cv2.GaussianBlur(plane, (11, 11), 1.5, borderType=cv2.BORDER_REFLECT)
+        mu_a, mu_b = window(a), window(b)
+        var_a = window(a * a) - mu_a ** 2
+        var_b = window(b * b) - mu_b ** 2
+        cov = window(a * b) - mu_a * mu_b
+        values.append((((2 * mu_a * mu_b + c1) * (2 * cov + c2)) /
+                       ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))).mean())
+    return float(np.mean(values))
+
+
 def save_images(img_tensors, img_names, save_dir):
     for img_tensor, img_name in zip(img_tensors, img_names):
         tensor = (img_tensor.clone() + 1) * 0.5 * 255
@@ -33,6 +144,18 @@ def save_images(img_tensors, img_names, save_dir):
         im.save(os.path.join(save_dir, img_name), format='JPEG')
 
 
+def available_memory():
+    """Bytes of memory the process can still allocate without swapping."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
 def load_checkpoint(model, checkpoint_path):
     if not os.path.exists(checkpoint_path):
         raise ValueError("'{}' is not a valid checkpoint path".format(checkpoint_path))